@@ -0,0 +1,68 @@
+import os
+import uuid
+import hashlib
+import numpy as np
+
+from utils.utils_ddp import rank0_print
+from .page_store import PageStore, StringColumn
+
+
+class AnnotationIndex:
+    """
+    Persistent index of an annotation directory, keyed by its full path. It keeps the pages left by
+    `EDGEAnnotationReader.reformat_and_filter` as the columns of a PageStore, together with the mtime and size of every
+    page annotation file, so that only new or modified files have to be parsed again.
+    """
+    version = 2
+
+    def __init__(self, index_dir, data_dir):
+        # image paths are relative to data_dir as given, like the ones read from the annotations
+        self.raw_dir = os.path.join(data_dir, "raw")
+        abs_data_dir = os.path.abspath(data_dir)
+        name = hashlib.sha1(abs_data_dir.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(index_dir, f"{os.path.basename(abs_data_dir)}_{name}.npz")
+        os.makedirs(index_dir, exist_ok=True)
+
+    def load(self):
+        """
+        Records {fname: (mtime, size, page_id, num_filtered_elements)} of the indexed files, where page_id is -1 for
+        filtered pages, and the PageStore of the valid pages.
+        """
+        if not os.path.exists(self.path):
+            return {}, None
+        with np.load(self.path) as columns:
+            columns = dict(columns)
+        if int(columns["version"]) != self.version:
+            rank0_print(f"Annotation index {self.path} is outdated, rebuilding it.")
+            return {}, None
+
+        page_store = PageStore.from_columns(columns)
+        img_names = page_store.page_strings["img_path"].tolist()
+        page_store.page_strings["img_path"] = StringColumn.from_strings(
+            [os.path.join(self.raw_dir, img_name) for img_name in img_names]
+        )
+        fnames = StringColumn(columns["fnames"], columns["fnames_offsets"]).tolist()
+        records = dict(zip(fnames, zip(
+            columns["mtimes"].tolist(), columns["sizes"].tolist(),
+            columns["page_ids"].tolist(), columns["num_filtered"].tolist()
+        )))
+        return records, page_store
+
+    def save(self, records, page_store):
+        columns = page_store.to_columns()
+        img_names = StringColumn.from_strings(
+            [os.path.relpath(img_path, self.raw_dir) for img_path in page_store.page_strings["img_path"].tolist()]
+        )
+        columns["page_img_path"], columns["page_img_path_offsets"] = img_names.buffer, img_names.offsets
+        fnames = StringColumn.from_strings(list(records.keys()))
+        columns["fnames"], columns["fnames_offsets"] = fnames.buffer, fnames.offsets
+        columns["mtimes"] = np.array([record[0] for record in records.values()], dtype=np.float64)
+        columns["sizes"] = np.array([record[1] for record in records.values()], dtype=np.int64)
+        columns["page_ids"] = np.array([record[2] for record in records.values()], dtype=np.int32)
+        columns["num_filtered"] = np.array([record[3] for record in records.values()], dtype=np.int32)
+        columns["version"] = np.array(self.version)
+
+        # other ranks may be writing the same index, the last complete one wins
+        tmp_path = f"{self.path[:-4]}.{uuid.uuid4().hex[:8]}.tmp.npz"
+        np.savez(tmp_path, **columns)
+        os.replace(tmp_path, self.path)
@@ -1,54 +1,171 @@
 import os
 import json
 import numpy as np
-from collections import Counter
+from functools import partial
+from multiprocessing import Pool
 from tqdm import tqdm
 
 from utils.utils_ddp import rank0_print
 from utils.utils_data import BoxUtils, TextUtils
+from .anno_index import AnnotationIndex
+from .page_store import PageStore
 
 
 class EDGEAnnotationReader:
     read_done_dirs = {}
-    max_pages = 9999999
+    num_workers = 1
+    index_dir = None
+    chunk_size = 64
 
     @classmethod
-    def get_dir_annos(cls, data_dir):
-        data_dir_name = data_dir.split("/")[-1]
-        if data_dir_name not in cls.read_done_dirs:
-            cls.read_anno_dir(data_dir)
-        return cls.read_done_dirs[data_dir_name]
+    def get_dir_annos(cls, data_dir, max_pages=None):
+        """
+        PageStore of the valid pages of a directory, only the first `max_pages` of them (in the listing order) if
+        given, in which case the reading stops there. A directory is read again only when a later call asks for more
+        pages than an earlier capped read got.
+        """
+        # keyed by the full path, as directories of the same name may live under different parents
+        data_dir_key = os.path.abspath(data_dir)
+        page_store, complete = cls.read_done_dirs.get(data_dir_key, (None, False))
+        if page_store is None or not complete and (max_pages is None or len(page_store) < max_pages):
+            page_store = cls.read_anno_dir(data_dir, max_pages)
+            # a capped read stops at exactly max_pages, while indexed reads always get all pages
+            complete = max_pages is None or len(page_store) != max_pages
+            cls.read_done_dirs[data_dir_key] = (page_store, complete)
+        if max_pages is not None and len(page_store) > max_pages:
+            page_store = page_store.select(range(max_pages))
+        return page_store
 
     @classmethod
-    def read_anno_dir(cls, data_dir):
+    def read_anno_dir(cls, data_dir, max_pages=None):
         # TODO: 适应新的标注格式
-        page_annos = []
-        num_filtered_elements = 0
         anno_dir = os.path.join(data_dir, "anno")
-        page_anno_fnames = [fname for fname in os.listdir(anno_dir) if fname.endswith(".json")]
-        for page_anno_fname in tqdm(page_anno_fnames):
-            with open(os.path.join(anno_dir, page_anno_fname), "r", encoding="utf-8") as f:
-                page_anno = json.load(f)
-            num_raw_elements = len(page_anno["elements"])
-            valid = cls.reformat_and_filter(page_anno)
-            if valid:
-                num_filtered_elements += num_raw_elements - len(page_anno["elements"])
-                page_annos.append(dict(
-                    img_path=os.path.join(data_dir, "raw", page_anno["image"]), 
-                    viewport=page_anno["viewport"],
-                    title=page_anno["title"], 
-                    description=page_anno["description"], 
-                    keywords=page_anno["keywords"],
-                    elements=page_anno["elements"]
-                ))
-                if len(page_annos) == cls.max_pages:
+        if cls.index_dir is not None:
+            page_store, num_filtered_elements, num_files = cls.read_indexed_pages(data_dir)
+        else:
+            page_annos = []
+            num_filtered_elements = []
+            page_anno_fnames = [fname for fname in os.listdir(anno_dir) if fname.endswith(".json")]
+            num_files = len(page_anno_fnames)
+            for result in cls.read_pages(data_dir, page_anno_fnames):
+                if result is None:
+                    continue
+                page_anno, num_page_filtered_elements = result
+                num_filtered_elements.append(num_page_filtered_elements)
+                page_annos.append(page_anno)
+                if len(page_annos) == max_pages:
                     break
+            page_store = PageStore.from_pages(page_annos)
+        num_filtered_elements = sum(num_filtered_elements[:len(page_store)])
         
         data_dir_name = data_dir.split("/")[-1]
-        num_filtered_pages = len(page_anno_fnames) - len(page_annos)
-        num_valid_elements = sum(len(page_anno["elements"]) for page_anno in page_annos)
-        rank0_print(f"Read {data_dir_name}: {num_filtered_pages} pages filtered, {len(page_annos)} left. Additionaly {num_filtered_elements} items filtered, {num_valid_elements} left.")
-        cls.read_done_dirs[data_dir_name] = page_annos
+        num_filtered_pages = num_files - len(page_store)
+        num_valid_elements = page_store.num_elements
+        rank0_print(f"Read {data_dir_name}: {num_filtered_pages} pages filtered, {len(page_store)} left. Additionaly {num_filtered_elements} items filtered, {num_valid_elements} left.")
+        return page_store
+
+    @classmethod
+    def read_pages(cls, data_dir, page_anno_fnames):
+        """Yield `read_page_annos` results in the listing order, so that a max_pages cap keeps the same pages."""
+        anno_dir = os.path.join(data_dir, "anno")
+        page_anno_paths = [os.path.join(anno_dir, fname) for fname in page_anno_fnames]
+        # pages are filtered in chunks, each by one call of the batched filter_pages
+        chunks = [page_anno_paths[i:i + cls.chunk_size] for i in range(0, len(page_anno_paths), cls.chunk_size)]
+        read_fn = partial(cls.read_page_annos, data_dir=data_dir)
+        pool = Pool(cls.num_workers) if cls.num_workers > 1 and len(chunks) > 1 else None
+        try:
+            results = pool.imap(read_fn, chunks) if pool is not None else map(read_fn, chunks)
+            with tqdm(total=len(page_anno_paths)) as pbar:
+                for chunk_results in results:
+                    pbar.update(len(chunk_results))
+                    yield from chunk_results
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    @classmethod
+    def read_indexed_pages(cls, data_dir):
+        """
+        PageStore of all valid pages of the directory in the listing order, with the numbers of their filtered elements
+        and the number of files. Unchanged files (by mtime and size) are taken from the persistent AnnotationIndex,
+        and only the others are parsed and added to it.
+        """
+        anno_dir = os.path.join(data_dir, "anno")
+        stats = {}
+        with os.scandir(anno_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    stats[entry.name] = (stat.st_mtime, stat.st_size)
+        
+        anno_index = AnnotationIndex(cls.index_dir, data_dir)
+        records, page_store = anno_index.load()
+        unchanged_fnames = [fname for fname, stat in stats.items() if records.get(fname, (None, None))[:2] == stat]
+        changed_fnames = [fname for fname, stat in stats.items() if records.get(fname, (None, None))[:2] != stat]
+        num_removed = len(records.keys() - stats.keys())
+        
+        # pages of unchanged files come first in the merged store, followed by the newly parsed ones
+        old_page_ids = [records[fname][2] for fname in unchanged_fnames if records[fname][2] >= 0]
+        fname2page = {fname: i for i, fname in enumerate(fname for fname in unchanged_fnames if records[fname][2] >= 0)}
+        new_pages = []
+        for fname, result in zip(changed_fnames, cls.read_pages(data_dir, changed_fnames)):
+            if result is not None:
+                page_anno, num_page_filtered_elements = result
+                fname2page[fname] = len(old_page_ids) + len(new_pages)
+                new_pages.append(page_anno)
+                records[fname] = (*stats[fname], -1, num_page_filtered_elements)
+            else:
+                records[fname] = (*stats[fname], -1, 0)
+        stores = [PageStore.from_pages(new_pages)]
+        if page_store is not None:
+            stores.insert(0, page_store.select(old_page_ids))
+        page_store = PageStore.concat(stores)
+        
+        # reorder the pages as listed, and renumber them in the records
+        listed_fnames = [fname for fname in stats if fname in fname2page]
+        page_store = page_store.select([fname2page[fname] for fname in listed_fnames])
+        records = {fname: (*records[fname][:2], -1, records[fname][3]) for fname in stats}
+        for page_id, fname in enumerate(listed_fnames):
+            records[fname] = (*records[fname][:2], page_id, records[fname][3])
+        if changed_fnames or num_removed:
+            anno_index.save(records, page_store)
+        rank0_print(f"Annotation index of {data_dir}: {len(unchanged_fnames)} files unchanged, {len(changed_fnames)} parsed, {num_removed} removed.")
+        num_filtered_elements = [records[fname][3] for fname in listed_fnames]
+        return page_store, num_filtered_elements, len(stats)
+
+    @classmethod
+    def read_page_annos(cls, page_anno_paths, data_dir):
+        """(page_anno, num_filtered_elements) of every valid page, or None for the filtered ones."""
+        page_annos = []
+        for page_anno_path in page_anno_paths:
+            with open(page_anno_path, "r", encoding="utf-8") as f:
+                page_anno = json.load(f)
+            num_raw_elements = len(page_anno["elements"])
+            page_annos.append((page_anno, num_raw_elements) if cls.reformat(page_anno) else None)
+        
+        valid_page_annos = [page_anno for page_anno, _ in filter(None, page_annos)]
+        keeps = iter(cls.filter_pages([(page_anno["elements"], page_anno["viewport"]) for page_anno in valid_page_annos]))
+        results = []
+        for result in page_annos:
+            if result is None:
+                results.append(None)
+                continue
+            page_anno, num_raw_elements = result
+            keep = next(keeps).tolist()
+            elements = [element for element, keep_element in zip(page_anno["elements"], keep) if keep_element]
+            if len(elements) == 0:
+                results.append(None)
+                continue
+            page_anno = dict(
+                img_path=os.path.join(data_dir, "raw", page_anno["image"]), 
+                viewport=page_anno["viewport"],
+                title=page_anno["title"], 
+                description=page_anno["description"], 
+                keywords=page_anno["keywords"],
+                elements=elements
+            )
+            results.append((page_anno, num_raw_elements - len(elements)))
+        return results
 
     @staticmethod
     def is_valid(page_anno):
@@ -71,6 +188,18 @@ class EDGEAnnotationReader:
 
     @staticmethod
     def reformat_and_filter(page_anno):
+        if not EDGEAnnotationReader.reformat(page_anno):
+            return False
+        valid_elements = EDGEAnnotationReader.filter_elements(page_anno["elements"], page_anno["viewport"])
+        if len(valid_elements) > 0:
+            page_anno["elements"] = valid_elements
+            return True
+        
+        return False
+
+    @staticmethod
+    def reformat(page_anno):
+        """Check the structure of the annotation of a page, and normalize the types and text of its elements."""
         if page_anno["description"] is None:
             page_anno["description"] = ""
         if page_anno["keywords"] is None:
@@ -95,68 +224,74 @@ class EDGEAnnotationReader:
                 return False
             element["types"] = set(types)
             element["text"] = TextUtils.replace_space(element["text"])
-        
-        valid_elements = EDGEAnnotationReader.filter_elements(page_anno["elements"], viewport)
-        if len(valid_elements) > 0:
-            page_anno["elements"] = valid_elements
-            return True
-        
-        return False
+        return True
 
     @staticmethod
     def filter_elements(elements, viewport):
+        keep = EDGEAnnotationReader.filter_pages([(elements, viewport)])[0]
+        return [element for element, keep_element in zip(elements, keep.tolist()) if keep_element]
+
+    @staticmethod
+    def filter_pages(pages):
+        """
+        Keep-masks of the elements of many (elements, viewport) pages at once. The rules are evaluated as array
+        operations over the elements of all pages, where only the text measures are taken per element.
+        """
         # TODO: 适应新的标注格式
-        valid_elements = []
+        num_elements = np.array([len(elements) for elements, _ in pages], dtype=np.int64)
+        num_pages = len(pages)
+        elements = [element for page_elements, _ in pages for element in page_elements]
+        if not elements:
+            return [np.zeros(n, dtype=bool) for n in num_elements.tolist()]
+        page_ids = np.repeat(np.arange(num_pages), num_elements)
+        bboxes = np.array([element["bbox"] for element in elements], dtype=np.int64).reshape(-1, 4)
+        viewports = np.array([viewport for _, viewport in pages]).reshape(-1, 2)
+        texts = [element["text"] for element in elements]
+        text_lens = np.array([len(text) for text in texts], dtype=np.int64)
+        word_counts = np.array([len(text.split()) for text in texts], dtype=np.int64)
+        text_only = np.array([element["types"] == {"Text"} for element in elements], dtype=bool)
+        has_types = np.array([len(element["types"]) > 0 for element in elements], dtype=bool)
+
+        def page_sum(values):
+            return np.bincount(page_ids, weights=values, minlength=num_pages)
+
+        width, height = bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            aspect = width / height
         ### 1 过滤质量不高的网页
         # 1.1 标注不能太多或太少
-        if len(elements) < 5 or len(elements) > 60:
-            return valid_elements
+        page_valid = (num_elements >= 5) & (num_elements <= 60)
         
         # 1.2 标注框必须都有效，且不能大部分都是特别扁长形的框
-        bboxes = np.array([element["bbox"] for element in elements])
-        width, height = BoxUtils.get_wh_array(bboxes)
-        if (width == 0).any() or (height == 0).any():
-            return valid_elements
-        vw, vh = viewport
-        if len(elements) > 5 and (width / height > 20).mean() > 0.5:
-            return valid_elements
+        page_valid &= page_sum((width == 0) | (height == 0)) == 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            page_valid &= ~((num_elements > 5) & (page_sum(aspect > 20) / num_elements > 0.5))
         
         # 1.3 标注框不能大部分都太小
-        if (width * height < vw * vh / 50**2).mean() > 0.4:
-            return valid_elements
+        vw, vh = viewports[page_ids, 0], viewports[page_ids, 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            page_valid &= ~(page_sum(width * height < vw * vh / 50**2) / num_elements > 0.4)
         
         # 1.4 不能大部分都是文本
-        text_elements = [element for element in elements if element["types"] == {"Text"}]
-        # word_count = sum(TextUtils.word_count(element["text"]) for element in text_elements)
-        word_count = sum(len(element["text"].split()) for element in text_elements)
-        if len(elements) > 5 and len(text_elements) / len(elements) > 0.8 or (word_count > 300 and word_count / len(text_elements) > 30):
-            return valid_elements
-            
+        num_text = page_sum(text_only)
+        word_count = page_sum(np.where(text_only, word_counts, 0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            page_valid &= ~(((num_elements > 5) & (num_text / num_elements > 0.8)) | ((word_count > 300) & (word_count / num_text > 30)))
+        
         ### 2 过滤网页中的极端标注
-        text2cnt = Counter([element["text"] for element in elements])
-        for element in elements:
-            text, bbox, types = element["text"], element["bbox"], element["types"]
-            width, height = BoxUtils.get_wh(bbox)
-            # 2.1 文本不能太长
-            if len(text) > 300 or len(text.split()) > 60:
-                continue 
-            
-            # 2.2 边界框长宽比例不能太极端
-            if height == 0 or width / height > 30 or width / height < 1/30:
-                continue
-            
-            # 2.3 元素不能太小（长、宽、面积）
-            if width < 20 or height < 20 or width * height < 500:
-                continue
-            
-            # 2.3 不能无类别
-            if len(types) == 0:
-                continue
-            
-            # 2.4 不能有重复项
-            if len(text) > 0 and text2cnt[text] > 1:
-                continue
-            
-            valid_elements.append(element)
-            
-        return valid_elements
+        keep = page_valid[page_ids].copy()
+        # 2.1 文本不能太长
+        keep &= (text_lens <= 300) & (word_counts <= 60)
+        # 2.2 边界框长宽比例不能太极端
+        keep &= (height != 0) & ~(aspect > 30) & ~(aspect < 1/30)
+        # 2.3 元素不能太小（长、宽、面积）
+        keep &= (width >= 20) & (height >= 20) & (width * height >= 500)
+        # 2.3 不能无类别
+        keep &= has_types
+        # 2.4 不能有重复项
+        text_ids = {}
+        text_keys = np.array([text_ids.setdefault(text, len(text_ids)) for text in texts], dtype=np.int64)
+        _, inverse, counts = np.unique(page_ids * len(text_ids) + text_keys, return_inverse=True, return_counts=True)
+        keep &= ~((text_lens > 0) & (counts[inverse.reshape(-1)] > 1))
+        
+        return np.split(keep, np.cumsum(num_elements)[:-1])
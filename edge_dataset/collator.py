@@ -0,0 +1,62 @@
+import math
+
+import torch
+from transformers.trainer_pt_utils import LabelSmoother
+
+
+class EDGEDataCollator:
+    """
+    Batch samples of EDGETensorDataset. Text tensors are right padded to the longest sequence in the batch (rounded up
+    to `pad_to_multiple_of`), while the image tiles of all samples are concatenated into (n_imgs, 5, C, H, W), so that
+    packed samples with different numbers of images can share a batch. Cached ViT features, and resized uint8 images
+    of (H, W, C) to be tiled on the device, are concatenated likewise. With adaptive tiling, images have different
+    numbers of tiles, so the tiles of all images are concatenated into (n_tiles, C, H, W) along with `num_tiles`.
+    Packed samples also get the `cu_seqlens` and `max_seqlen` of their segments for varlen flash attention, computed
+    here on the CPU so that the model does not wait for the GPU to find them.
+    """
+    image_ndims = {"images": 4, "image_features": 3}
+
+    def __init__(self, pad_token_id, pad_to_multiple_of=1):
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.pad_values = {
+            "input_ids": pad_token_id,
+            "labels": LabelSmoother.ignore_index,
+            "attention_mask": False,
+        }
+
+    def __call__(self, features):
+        seq_len = max(len(feature["input_ids"]) for feature in features)
+        seq_len = math.ceil(seq_len / self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        batch = {}
+        tiled = "num_tiles" in features[0]
+        for key in features[0].keys():
+            if key == "num_tiles":
+                batch[key] = torch.cat([feature[key] for feature in features])
+            elif key in self.image_ndims:
+                ndim = 3 if features[0][key].dtype == torch.uint8 or tiled else self.image_ndims[key]
+                batch[key] = torch.cat([feature[key].view(-1, *feature[key].shape[-ndim:]) for feature in features])
+            else:
+                batch[key] = torch.stack([self.pad(key, feature[key], seq_len) for feature in features])
+        if "position_ids" in batch:
+            batch["cu_seqlens"], batch["max_seqlen"] = self.get_cu_seqlens(batch["position_ids"])
+        return batch
+
+    @staticmethod
+    def get_cu_seqlens(position_ids):
+        """Cumulative lengths of the segments of packed samples flattened over the batch, and the longest one."""
+        position_ids = position_ids.flatten()
+        starts = torch.nonzero(position_ids.eq(0)).flatten()
+        cu_seqlens = torch.cat((starts, torch.tensor([len(position_ids)]))).to(torch.int32)
+        return cu_seqlens, int((cu_seqlens[1:] - cu_seqlens[:-1]).max())
+
+    def pad(self, key, tensor, seq_len):
+        num_pad = seq_len - len(tensor)
+        if num_pad <= 0:
+            return tensor
+        if key == "position_ids":
+            # padding of packed samples forms a segment of its own
+            padding = torch.arange(num_pad, dtype=tensor.dtype)
+        else:
+            padding = torch.full((num_pad,), self.pad_values[key], dtype=tensor.dtype)
+        return torch.cat((tensor, padding))
@@ -2,20 +2,28 @@ import os
 import re
 import json
 import random
+import itertools
+import numpy as np
 from PIL import Image
 from tqdm import tqdm
 from collections import defaultdict
+from multiprocessing import Pool
 
 import torch
-import torch.nn.functional as F
 from torch.utils.data import Dataset
-from torchvision import transforms
-import torchvision.transforms.functional as TF
 from transformers.trainer_pt_utils import LabelSmoother
 
+from monkey_model import image_processing
 from utils.utils_data import BoxUtils, TextUtils
-from utils.utils_ddp import rank0_print
+from utils.utils_ddp import barrier, is_main_process, rank0_print
 from .anno_reader import EDGEAnnotationReader
+from .token_cache import TokenCache
+from .image_cache import ImageCache
+from .feature_store import ViTFeatureStore
+from .item_store import ItemStore
+from .file_index import FileIndex
+from .image_index import ImageIndex
+from .json_records import Reservoir, iter_json_records, iter_shuffled_json_records, sample_json_records
 from . import prompts
 
 
@@ -37,7 +45,11 @@ class LegalTasks:
 
 class GeneralDataset:
     legal_elem_tasks = {}
-    
+    # ImageIndex of the images known to be unusable, whose items are skipped
+    image_index = None
+    # whether QAs can be created unit by unit (see `create_unit_item`), i.e. on the fly by EDGETensorDataset
+    lazy_supported = False
+
     @staticmethod
     def create_vqa_text_dataset(task, task_meta):
         if task == "basic" or task == "basic_cropped":
@@ -70,6 +82,7 @@ class GeneralDataset:
         self.max_items = task_meta.get("max_items", 99999999)
         self.repeated_time = task_meta.get("repeated_time", 1)
         assert self.elem_tasks.issubset(self.legal_elem_tasks)
+        self.skipped_images = defaultdict(set)
         self.read_annos()
         self.qa_data = {}
 
@@ -103,17 +116,35 @@ class GeneralDataset:
     def create_qa_data(self):
         return NotImplementedError
     
+    def num_units(self):
+        """Number of units (e.g. pages) that QAs are created from, one item at most per unit."""
+        raise NotImplementedError
+    
+    def create_unit_qa(self, unit_idx):
+        raise NotImplementedError
+    
+    def create_unit_item(self, unit_idx):
+        """The item created from a single unit, or None if it has no QA. It replaces the QAs created so far."""
+        self.qa_data = {elem_task: [] for elem_task in self.elem_tasks}
+        self.create_unit_qa(unit_idx)
+        items = list(itertools.chain.from_iterable(self.qa_data.values()))
+        return items[0] if items else None
+    
     def create_done_message(self):
         num_images, num_total = self.get_all_count()
         message = f"{num_images} images ({num_total} QAs), where"
         for elem_task in self.elem_tasks:
             num_images, num_total = self.get_elem_task_count(elem_task)
             message += f"\n\t{elem_task}: {num_images} ({num_total})"
+            if self.skipped_images[elem_task]:
+                skipped_images = self.skipped_images[elem_task]
+                message += f", {len(skipped_images)} missing or invalid images skipped, e.g. {min(skipped_images)}"
         return message
     
     def add_item(self, elem_task, img_path, sys_prompt, questions, answers):
-        if not os.path.exists(img_path):
-            print(f"Image: {img_path} not found in task {elem_task}! Skip it.")
+        if not FileIndex.exists(img_path) or self.image_index is not None and not self.image_index.is_valid(img_path):
+            # reported in bulk by create_done_message
+            self.skipped_images[elem_task].add(img_path)
             return
         assert len(questions) == len(answers)
         
@@ -144,138 +175,162 @@ class GeneralDataset:
         return str(bbox)
     
 
-class BasicDataset(GeneralDataset):
-    legal_elem_tasks = LegalTasks.BASIC
+class PageTaskDataset(GeneralDataset):
+    """Tasks whose QAs are created page by page from the PageStores of annotation directories, a unit per page."""
+    lazy_supported = True
+    # number of pages read from every directory, None for all of them
+    max_pages = None
     def __init__(self, task, task_meta):
-        self.page_annos = []
-        EDGEAnnotationReader.max_pages = task_meta.pop("max_items", 9999999)
+        self.page_stores = []
         super().__init__(task, task_meta)
-
-        self.num_per_page = task_meta.pop("num_per_page", 99)
     
     def read_annos(self):
         for data_dir in self.data_dir:
-            self.page_annos.extend(EDGEAnnotationReader.get_dir_annos(data_dir))
+            self.page_stores.append(EDGEAnnotationReader.get_dir_annos(data_dir, self.max_pages))
+        self.store_offsets = np.cumsum([0] + [len(page_store) for page_store in self.page_stores])
+    
+    def num_units(self):
+        return int(self.store_offsets[-1])
+    
+    def get_page(self, unit_idx):
+        """Index of the page store of a unit, and the page id in it."""
+        store_idx = int(np.searchsorted(self.store_offsets, unit_idx, side="right")) - 1
+        return store_idx, unit_idx - int(self.store_offsets[store_idx])
+    
+    def create_qa_data(self):
+        for elem_task in self.elem_tasks:
+            self.qa_data[elem_task] = []
+        
+        for unit_idx in range(int(self.store_offsets[-1])):
+            self.create_unit_qa(unit_idx)
+
+
+class BasicDataset(PageTaskDataset):
+    legal_elem_tasks = LegalTasks.BASIC
+    def __init__(self, task, task_meta):
+        self.element_valid = {}
+        self.max_pages = task_meta.pop("max_items", None)
+        super().__init__(task, task_meta)
+
+        self.num_per_page = task_meta.pop("num_per_page", 99)
         
     def read_done_message(self):
-        num_pages = len(self.page_annos)
-        num_elements = sum(len(page_anno["elements"]) for page_anno in self.page_annos)
+        num_pages = sum(len(page_store) for page_store in self.page_stores)
+        num_elements = sum(page_store.num_elements for page_store in self.page_stores)
         return f"Successfully read {num_elements} valid elements in {num_pages} pages."
         
-    def create_qa_data(self):
-        for elem_task in self.elem_tasks:
-            self.qa_data[elem_task] = []
+    def get_element_valid(self, store_idx):
+        """Mask of the elements of a page store with text, a valid bbox and no Image/Icon type."""
+        if store_idx not in self.element_valid:
+            page_store = self.page_stores[store_idx]
+            bboxes, text_bytes = page_store.bboxes, page_store.element_strings["text"].num_bytes()
+            x1, y1, x2, y2 = bboxes[:, 0], bboxes[:, 1], bboxes[:, 2], bboxes[:, 3]
+            W, H = np.repeat(page_store.viewports, np.diff(page_store.element_offsets), axis=0).T
+            self.element_valid[store_idx] = (text_bytes > 0) & (0 <= x1) & (x1 <= x2) & (x2 <= W) \
+                & (0 <= y1) & (y1 <= y2) & (y2 <= H) & (page_store.types & page_store.type_mask({"Image", "Icon"}) == 0)
+        return self.element_valid[store_idx]
+    
+    def create_unit_qa(self, unit_idx):
+        store_idx, page_id = self.get_page(unit_idx)
+        page_store, element_valid = self.page_stores[store_idx], self.get_element_valid(store_idx)
+        img_path = page_store.get_page_string("img_path", page_id)
+        viewport = page_store.get_viewport(page_id)
+        element_ids = [element_id for element_id in page_store.get_element_ids(page_id) if element_valid[element_id]]
         
-        for page_anno in self.page_annos:
-            img_path, elements = page_anno["img_path"], page_anno["elements"]
-            elements = list(filter(
-                lambda element: len(element["text"]) > 0 \
-                    and BoxUtils.is_valid(element["bbox"], size=page_anno["viewport"]) \
-                    and len(element["types"] & {"Image", "Icon"}) == 0,
-                elements
-            ))
+        elem_task = random.sample(self.elem_tasks, 1)[0]
+        bbox_format = random.choice(prompts.bbox_formats)
+        sys_prompt = prompts.add_bbox_suffix(random.choice(prompts.basic[elem_task]), bbox_format)
+        questions = []
+        answers = []
+        for element_id in random.sample(element_ids, min(len(element_ids), self.num_per_page)):
+            text, bbox = page_store.get_element_string("text", element_id), page_store.get_bbox(element_id)
+            text = TextUtils.truncate_both(text, max_words=30, max_len=300)
+            bbox = BoxUtils.normalize(bbox, viewport)
             
-            elem_task = random.sample(self.elem_tasks, 1)[0]
-            bbox_format = random.choice(prompts.bbox_formats)
-            sys_prompt = prompts.add_bbox_suffix(random.choice(prompts.basic[elem_task]), bbox_format)
-            questions = []
-            answers = []
-            for element in random.sample(elements, min(len(elements), self.num_per_page)):
-                text, bbox = element["text"], element["bbox"]
-                text = TextUtils.truncate_both(text, max_words=30, max_len=300)
-                bbox = BoxUtils.normalize(bbox, page_anno["viewport"])
-                
-                if elem_task == "grounding":
-                    question = text
-                    answer = self.format_bbox(bbox_format, bbox, random=False)
-                elif elem_task == "ocr":
-                    question = self.format_bbox(bbox_format, bbox, random=True)
-                    answer = text
-                questions.append(question)
-                answers.append(answer)
-            self.add_item(elem_task, img_path, sys_prompt, questions, answers)
+            if elem_task == "grounding":
+                question = text
+                answer = self.format_bbox(bbox_format, bbox, random=False)
+            elif elem_task == "ocr":
+                question = self.format_bbox(bbox_format, bbox, random=True)
+                answer = text
+            questions.append(question)
+            answers.append(answer)
+        self.add_item(elem_task, img_path, sys_prompt, questions, answers)
 
 
-class AccessibilityDataset(GeneralDataset):
+class AccessibilityDataset(PageTaskDataset):
     legal_elem_tasks = LegalTasks.ACCESSIBILITY
     def __init__(self, task, task_meta):
-        self.page_annos = []
         super().__init__(task, task_meta)
         
         self.num_per_page = task_meta.pop("num_per_page", 99)
-    def read_annos(self):
-        for data_dir in self.data_dir:
-            self.page_annos.extend(EDGEAnnotationReader.get_dir_annos(data_dir))
     
     def read_done_message(self):
-        return f"Successfully read {len(self.page_annos)} pages."
+        return f"Successfully read {sum(len(page_store) for page_store in self.page_stores)} pages."
     
-    def create_qa_data(self):
-        for elem_task in self.elem_tasks:
-            self.qa_data[elem_task] = []
-
-        for page_anno in self.page_annos:
-            img_path, elements = page_anno["img_path"], page_anno["elements"]
-            random.shuffle(elements)
+    def num_units(self):
+        # max_items caps the items of every elem_task, which is approximated on the fly by capping the pages
+        return min(super().num_units(), self.max_items * len(self.elem_tasks))
+    
+    def create_unit_qa(self, unit_idx):
+        store_idx, page_id = self.get_page(unit_idx)
+        page_store = self.page_stores[store_idx]
+        image_icon_mask = page_store.type_mask({"Image", "Icon"})
+        img_path = page_store.get_page_string("img_path", page_id)
+        viewport = page_store.get_viewport(page_id)
+        element_ids = list(page_store.get_element_ids(page_id))
+        random.shuffle(element_ids)
+        
+        elem_task = random.sample(self.elem_tasks, 1)[0]
+        bbox_format = random.choice(prompts.bbox_formats)
+        sys_prompt = prompts.add_bbox_suffix(random.choice(prompts.accessibility[elem_task]), bbox_format)
+        questions = []
+        answers = []
+        num_cur_page = 0
+        for element_id in element_ids:
+            if num_cur_page == self.num_per_page:
+                break
             
-            elem_task = random.sample(self.elem_tasks, 1)[0]
-            bbox_format = random.choice(prompts.bbox_formats)
-            sys_prompt = prompts.add_bbox_suffix(random.choice(prompts.accessibility[elem_task]), bbox_format)
-            questions = []
-            answers = []
-            num_cur_page = 0
-            for element in elements:
-                if num_cur_page == self.num_per_page:
-                    break
-                
-                text, bbox, types = element["text"], element["bbox"], element["types"]
-                bbox = BoxUtils.normalize(bbox, page_anno["viewport"])
+            text, bbox = page_store.get_element_string("text", element_id), page_store.get_bbox(element_id)
+            bbox = BoxUtils.normalize(bbox, viewport)
 
-                if elem_task == "general_acb":
-                    acb_text = element["ariaLabel"] if not element["title"] else element["title"]
-                    if len(acb_text) == 0 or acb_text == text:
-                        continue
-                    question = self.format_bbox(bbox_format, bbox, random=True)
-                    answer = acb_text
-                elif elem_task == "image_alt":
-                    if len(types & {"Image", "Icon"}) == 0 or len(text) == 0:
-                        continue
-                    question = self.format_bbox(bbox_format, bbox, random=True)
-                    answer = text
-                questions.append(question)
-                answers.append(answer)
-                num_cur_page += 1
-            if len(self.qa_data[elem_task]) < self.max_items:
-                self.add_item(elem_task, img_path, sys_prompt, questions, answers)
+            if elem_task == "general_acb":
+                title = page_store.get_element_string("title", element_id)
+                acb_text = page_store.get_element_string("ariaLabel", element_id) if not title else title
+                if len(acb_text) == 0 or acb_text == text:
+                    continue
+                question = self.format_bbox(bbox_format, bbox, random=True)
+                answer = acb_text
+            elif elem_task == "image_alt":
+                if page_store.types[element_id] & image_icon_mask == 0 or len(text) == 0:
+                    continue
+                question = self.format_bbox(bbox_format, bbox, random=True)
+                answer = text
+            questions.append(question)
+            answers.append(answer)
+            num_cur_page += 1
+        if len(self.qa_data[elem_task]) < self.max_items:
+            self.add_item(elem_task, img_path, sys_prompt, questions, answers)
 
 
-class CaptioningDataset(GeneralDataset):
+class CaptioningDataset(PageTaskDataset):
     legal_elem_tasks = LegalTasks.CAPTIONING
-    def __init__(self, task, task_meta):
-        self.page_annos = []
-        super().__init__(task, task_meta)
-
-    def read_annos(self):
-        for data_dir in self.data_dir:
-            self.page_annos.extend(EDGEAnnotationReader.get_dir_annos(data_dir))
     
     def read_done_message(self):
-        return f"Successfully read {len(self.page_annos)} pages."
+        return f"Successfully read {sum(len(page_store) for page_store in self.page_stores)} pages."
     
-    def create_qa_data(self):
-        for elem_task in self.elem_tasks:
-            self.qa_data[elem_task] = []
-
-        for page_anno in self.page_annos:
-            img_path = page_anno["img_path"]
-            elem_task = random.sample(self.elem_tasks, 1)[0]
-            
-            caption = page_anno[elem_task]
-            if len(caption) == 0:
-                continue
-            question = random.choice(prompts.captioning[elem_task])
-            answer = caption
-            self.add_item(elem_task, img_path, "", [question], [answer])
+    def create_unit_qa(self, unit_idx):
+        store_idx, page_id = self.get_page(unit_idx)
+        page_store = self.page_stores[store_idx]
+        img_path = page_store.get_page_string("img_path", page_id)
+        elem_task = random.sample(self.elem_tasks, 1)[0]
+        
+        caption = page_store.get_page_string(elem_task, page_id)
+        if len(caption) == 0:
+            return
+        question = random.choice(prompts.captioning[elem_task])
+        answer = caption
+        self.add_item(elem_task, img_path, "", [question], [answer])
 
 
 class IconMixedDataset(GeneralDataset):
@@ -286,12 +341,10 @@ class IconMixedDataset(GeneralDataset):
         self.num_per_page = task_meta.pop("num_per_page", 99)
 
     def read_annos(self):
-        with open(os.path.join(self.data_dir, "record.json")) as f:
-            self.img_annos = json.load(f)
-        random.shuffle(self.img_annos)
+        self.img_annos, self.num_images = sample_json_records(os.path.join(self.data_dir, "record.json"), self.max_items)
     
     def read_done_message(self):
-        return f"Successfully read 1 file with {len(self.img_annos)} images."
+        return f"Successfully read 1 file with {self.num_images} images, {len(self.img_annos)} sampled."
         
     def create_qa_data(self):
         rand_etasks = list(self.elem_tasks & {"icon_grounding", "icon_referring"})
@@ -346,18 +399,17 @@ class SoMDataset(GeneralDataset):
     legal_elem_tasks = LegalTasks.SOM
     def __init__(self, task, task_meta):
         self.img_annos = {}
+        self.num_images = {}
         super().__init__(task, task_meta)
 
     def read_annos(self):
-        with open(os.path.join(self.data_dir, "record_general.json")) as f:
-            self.img_annos["som_general"] = json.load(f)
-        with open(os.path.join(self.data_dir, "record_icon_mixed.json")) as f:
-            self.img_annos["som_icon"] = json.load(f)
-        random.shuffle(self.img_annos["som_general"])
-        random.shuffle(self.img_annos["som_icon"])
+        for elem_task, fname in (("som_general", "record_general.json"), ("som_icon", "record_icon_mixed.json")):
+            self.img_annos[elem_task], self.num_images[elem_task] = sample_json_records(
+                os.path.join(self.data_dir, fname), self.max_items
+            )
     
     def read_done_message(self):
-        return f"Successfully read 2 file with {len(self.img_annos['som_general'])} general and {len(self.img_annos['som_icon'])} icon_mixed images."
+        return f"Successfully read 2 file with {self.num_images['som_general']} general and {self.num_images['som_icon']} icon_mixed images."
     
     def create_qa_data(self):
         for elem_task in self.elem_tasks:
@@ -366,7 +418,6 @@ class SoMDataset(GeneralDataset):
                 img_name, text, bbox = img_anno["image"], img_anno["text"], img_anno["bbox"]
                 img_dir = "images_" + ("general" if elem_task == "som_general" else "icon_mixed")
                 img_path = os.path.join(self.data_dir, img_dir, img_name)
-                assert os.path.exists(img_path), img_path
                 if not BoxUtils.is_valid(bbox, size=img_anno["size"]):
                     continue
                 bbox = BoxUtils.normalize(bbox, size=img_anno["size"])
@@ -393,9 +444,9 @@ class IconDescDataset(GeneralDataset):
 
     def read_annos(self):
         for data_dir in self.data_dir:
-            with open(os.path.join(data_dir, "icon_desc.json")) as f:
-                icon_anno = json.load(f)
-            self.annos[data_dir] = icon_anno
+            # only the first max_items icons are used, so the rest is never parsed
+            icon_anno = iter_json_records(os.path.join(data_dir, "icon_desc.json"))
+            self.annos[data_dir] = list(itertools.islice(icon_anno, self.max_items))
             
     def read_done_message(self):
         return f"Successfully read {len(self.annos)} parts of icon annotations."
@@ -406,7 +457,6 @@ class IconDescDataset(GeneralDataset):
         for data_dir, icon_anno in self.annos.items():
             for icon_item in icon_anno[:self.max_items]:
                 img_path = os.path.join(data_dir, "pngs_bg", icon_item["image"])
-                assert os.path.exists(img_path)
                 question = random.choice(prompts.icon_description)
                 answer = icon_item["desc"]
                 self.add_item(elem_task, img_path, "", [question], [answer])
@@ -425,10 +475,8 @@ class RicoTasksDataset(GeneralDataset):
             assert os.path.isdir(elem_task_dir)
             elem_task_anno = {}
             for fname in filter(lambda x: x.endswith(".json"), os.listdir(elem_task_dir)):
-                key = fname[:-5]
-                with open(os.path.join(elem_task_dir, fname), "r", encoding="utf-8") as f:
-                    annotation = json.load(f)
-                elem_task_anno[key] = annotation
+                # parsed while the QAs are created, as many records as needed
+                elem_task_anno[fname[:-5]] = os.path.join(elem_task_dir, fname)
             self.annos[elem_task] = elem_task_anno
     
     def read_done_message(self):
@@ -442,9 +490,10 @@ class RicoTasksDataset(GeneralDataset):
         for elem_task in self.elem_tasks:
             self.qa_data[elem_task] = []
             assert len(self.annos[elem_task]) == 1
-            annotation = next(iter(self.annos[elem_task].values()))
-            random.shuffle(annotation)
+            annotation = iter_shuffled_json_records(next(iter(self.annos[elem_task].values())))
             for i, item in enumerate(annotation):
+                if len(self.qa_data[elem_task]) == self.max_items:
+                    break
                 img_path = os.path.join(self.img_dir, item["img_filename"])
                 bbox_format = random.choice(prompts.bbox_formats)
                 if elem_task == "screen2words":
@@ -472,6 +521,7 @@ class RicoTasksDataset(GeneralDataset):
 
 class AdvancedTasksDataset(GeneralDataset):
     legal_elem_tasks = LegalTasks.ADVANCED_TASKS
+    lazy_supported = True
     def __init__(self, task, task_meta):
         self.tasks_annos = {}
         self.max_items = task_meta.get("max_items", 99999)
@@ -491,6 +541,10 @@ class AdvancedTasksDataset(GeneralDataset):
                         elem_task_data[key] = page_anno
             if elem_task_data:
                 self.tasks_annos[elem_task] = elem_task_data
+        self.units = [
+            (elem_task, key) for elem_task in sorted(self.tasks_annos)
+            for key in list(self.tasks_annos[elem_task])[:self.max_items]
+        ]
     
     def read_done_message(self):
         message = "Successfully read: "
@@ -499,51 +553,68 @@ class AdvancedTasksDataset(GeneralDataset):
             message += f"\n\t{elem_task}: {num_data_task}"
         return message
     
+    def num_units(self):
+        return len(self.units)
+    
     def create_qa_data(self):
         for elem_task in self.elem_tasks:
             self.qa_data[elem_task] = []
-            for key, page_anno in list(self.tasks_annos[elem_task].items())[:self.max_items]:
-                data_dir, page_name = key.split(";")
-                img_path = f"{data_dir}/raw/{page_name}.png"
+            for key in list(self.tasks_annos[elem_task])[:self.max_items]:
                 for _ in range(self.repeated_time):
-                    if elem_task == "intention":
-                        questions = []
-                        answers = []
-                        for qa in page_anno:
-                            answer = qa["System"]
-                            if not intention_pattern.search(answer):
-                                continue
-                            answer = intention_pattern.sub(r"(\2)", answer)
-                            questions.append(qa["User"])
-                            answers.append(answer)
-                        self.add_item(elem_task, img_path, "", questions, answers)
-                    elif elem_task == "detail" or elem_task == "function":
-                        question = random.choice(prompts.advanced_tasks[elem_task])
-                        answer = page_anno
-                        self.add_item(elem_task, img_path, "", [question], [answer])
+                    self.add_page_qa(elem_task, key)
+    
+    def create_unit_qa(self, unit_idx):
+        # QAs created on the fly are drawn afresh every epoch, so units are not repeated
+        self.add_page_qa(*self.units[unit_idx])
+    
+    def add_page_qa(self, elem_task, key):
+        page_anno = self.tasks_annos[elem_task][key]
+        data_dir, page_name = key.split(";")
+        img_path = f"{data_dir}/raw/{page_name}.png"
+        if elem_task == "intention":
+            questions = []
+            answers = []
+            for qa in page_anno:
+                answer = qa["System"]
+                if not intention_pattern.search(answer):
+                    continue
+                answer = intention_pattern.sub(r"(\2)", answer)
+                questions.append(qa["User"])
+                answers.append(answer)
+            self.add_item(elem_task, img_path, "", questions, answers)
+        elif elem_task == "detail" or elem_task == "function":
+            question = random.choice(prompts.advanced_tasks[elem_task])
+            answer = page_anno
+            self.add_item(elem_task, img_path, "", [question], [answer])
 
 
 class MonkeyTrainingDataset(GeneralDataset):
     legal_elem_tasks = LegalTasks.MONKEY_TRAINING
     def __init__(self, task, task_meta):
         self.annos = []
+        self.num_qa_pairs = 0
+        self.desc_ratio = 0.75
         super().__init__(task, task_meta)
         
         assert len(self.elem_tasks) == 1
         self.img_tag = re.compile(r"</img> ")
         self.answer_suffix = re.compile(r" ?Answer: ?")
         self.img_dir = task_meta.get("img_dir", "datasets/MonkeyData/Monkey_Train_data")
-        self.desc_ratio = 0.75
-        self.total_num_desc = int(self.max_items * self.desc_ratio)
-        self.total_num_vqa = self.max_items - self.total_num_desc
     
     def read_annos(self):
-        with open(os.path.join(self.data_dir, "train_monkey.json")) as f:
-            self.annos = json.load(f)
+        self.total_num_desc = int(self.max_items * self.desc_ratio)
+        self.total_num_vqa = self.max_items - self.total_num_desc
+        # a reservoir per kind of question, as large as the number of them create_qa_data keeps
+        vqa_pairs, desc_pairs = Reservoir(self.total_num_vqa), Reservoir(self.total_num_desc)
+        for qa_pair in iter_json_records(os.path.join(self.data_dir, "train_monkey.json")):
+            is_vqa = qa_pair["conversations"][0]["value"].endswith(" Answer: ")
+            (vqa_pairs if is_vqa else desc_pairs).add(qa_pair)
+        self.annos = vqa_pairs.records + desc_pairs.records
+        self.num_qa_pairs = vqa_pairs.num_seen + desc_pairs.num_seen
         random.shuffle(self.annos)
 
     def read_done_message(self):
-        return f"Successfully read {len(self.annos)} qa_pairs."
+        return f"Successfully read {self.num_qa_pairs} qa_pairs, {len(self.annos)} sampled."
 
     def create_qa_data(self):
         elem_task = next(iter(self.elem_tasks))
@@ -584,12 +655,12 @@ class LLaVAInstructDataset(GeneralDataset):
         assert len(self.elem_tasks) == 1
     
     def read_annos(self):
-        with open(os.path.join(self.data_dir, "llava_instruct_150k.json")) as f:
-            self.annos = json.load(f)
-        random.shuffle(self.annos)
+        self.annos, self.num_images = sample_json_records(
+            os.path.join(self.data_dir, "llava_instruct_150k.json"), self.max_items
+        )
 
     def read_done_message(self):
-        return f"Successfully read {len(self.annos)} images."
+        return f"Successfully read {self.num_images} images, {len(self.annos)} sampled."
 
     def create_qa_data(self):
         elem_task = next(iter(self.elem_tasks))
@@ -620,68 +691,578 @@ class LLaVAInstructDataset(GeneralDataset):
 
 class EDGETensorDataset(Dataset):
 
-    image_transform = transforms.Compose([
-        transforms.Resize((896, 896), interpolation=TF.InterpolationMode.BICUBIC),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=(0.48145466, 0.4578275, 0.40821073), std=(0.26862954, 0.26130258, 0.27577711)),
-    ])
     tokenized = None
     ignore_token_id = LabelSmoother.ignore_index
+    # resampler queries per image tile, i.e. image-pad tokens per tile
+    tile_seq_len = 256
+    # tiles of the fixed 2x2 tiling, to whose span the tokenizer pads every image
+    fixed_num_tiles = 5
     
-    def __init__(self, tokenizer, dataset_meta=None, items_filepath=None):
+    def __init__(self, tokenizer, dataset_meta=None, items_filepath=None, packing=None, grouping=None, splitting=None, mixture=None, tiling=None, pad_to_max_len=True, 
+                 token_cache_dir=None, image_cache_dir=None, image_cache_size_gb=200, image_transport="float32", vit_feature_dir=None, num_workers=1, items_build_dir=None,
+                 anno_index_dir=None, image_index_path=None, measure_lengths=False, seed=0):
         assert dataset_meta or items_filepath, "dataset_meta and items_filepath can not be None simultaneously!"
         super().__init__()
+        use_packing = packing and packing.get("enable", True)
+        use_grouping = grouping and grouping.get("enable", True)
+        if not items_filepath and any(task_meta.get("lazy") for task_meta in dataset_meta.values()):
+            assert not (use_packing or use_grouping or items_build_dir or vit_feature_dir), \
+                "Lazy tasks can not be used with packing, grouping, items_build_dir or cached ViT features!"
         self.tokenizer = tokenizer
         self.max_len = tokenizer.model_max_length
         self.ignore_token_id = LabelSmoother.ignore_index
         self.pad_token_id = tokenizer.pad_token_id
+        self.pad_to_max_len = pad_to_max_len
+        self.token_cache = TokenCache(token_cache_dir, tokenizer, self.max_len, self.tokenize_item) if token_cache_dir else None
+        assert image_transport in ("float32", "bf16", "uint8"), f"Invalid image transport: {image_transport}!"
+        self.image_transport = image_transport
+        self.image_cache = None
+        if image_cache_dir:
+            self.image_cache = ImageCache(image_cache_dir, self.read_resized_img, max_bytes=image_cache_size_gb * 1024**3)
+        self.feature_store = ViTFeatureStore(vit_feature_dir) if vit_feature_dir else None
+        # grids of windows chosen per image under per-task budgets, see read_image_input
+        self.tiling = tiling if tiling and tiling.get("enable", True) else None
+        if self.tiling is not None:
+            assert not (image_cache_dir or vit_feature_dir or image_transport == "uint8"), \
+                "Adaptive tiling can not be used with image_cache_dir, cached ViT features or uint8 image transport!"
+            # the largest span after the text before it must fit in max_len, otherwise its items would all be dropped
+            budgets = [self.tiling.get("max_windows", 4), *self.tiling.get("task_max_windows", {}).values()]
+            max_tiles = max(budget + 1 if budget > 1 else 1 for budget in budgets)
+            img_overhead, system_len = self.get_template_overheads()
+            assert system_len + img_overhead + (max_tiles - self.fixed_num_tiles) * self.tile_seq_len <= self.max_len, \
+                f"Image spans of {max_tiles} tiles do not fit in model_max_length ({self.max_len}), lower the window budgets!"
+        self.image_key = "image_features" if self.feature_store is not None else "images"
         
         self.items = []
+        self.item_lengths = None
+        self.lazy_readers = {}
+        self.lazy_offsets = np.zeros(1, dtype=np.int64)
+        self.seed = seed
+        self.epoch = 0
+        # read by EDGETrainer to draw samples from per-task pools (see TaskMixtureBatchSampler)
+        self.mixture = mixture if mixture and mixture.get("enable", True) else None
+        if items_build_dir:
+            # Rank 0 builds the items for the whole job, which all ranks memory-map after the barrier
+            items_path = os.path.join(items_build_dir, "items.jsonl")
+            if is_main_process():
+                os.makedirs(items_build_dir, exist_ok=True)
+                self.build_items(dataset_meta, items_filepath, grouping, splitting, num_workers, anno_index_dir, image_index_path)
+                # lengths are stored along for the samplers of all ranks, instead of being measured by each of them
+                ItemStore.write(items_path, self.items, self.get_item_lengths() if use_packing or measure_lengths else None)
+            barrier()
+            self.task2vqas = defaultdict(lambda: defaultdict(list))
+            self.items = ItemStore(items_path)
+            self.item_lengths = self.items.lengths
+        else:
+            self.build_items(dataset_meta, items_filepath, grouping, splitting, num_workers, anno_index_dir, image_index_path)
+        if self.token_cache is not None:
+            # filled before the dataloader workers fork, so that they never tokenize an item themselves
+            if is_main_process():
+                self.token_cache.build(self.items, num_workers)
+            barrier()
+            self.token_cache.load_index()
+        
+        self.packs = None
+        if use_packing:
+            self.pack_len = packing.get("max_len", 4096)
+            self.packs = self.pack_items(self.pack_len, packing.get("max_items_per_pack", 8))
+        
+    def build_items(self, dataset_meta=None, items_filepath=None, grouping=None, splitting=None, num_workers=1,
+                    anno_index_dir=None, image_index_path=None):
         if items_filepath:
             self.task2vqas = defaultdict(lambda: defaultdict(list))
             self.items = self.load_jsonl_items(items_filepath)
         else:
-            self.task2vqas = self.create_vqa_text_dataset(dataset_meta)
+            self.task2vqas, self.lazy_readers = self.create_vqa_text_dataset(dataset_meta, num_workers, anno_index_dir, image_index_path)
             self.fill_img_path(self.task2vqas)
-            self.items = sum((item for task in dataset_meta.keys() for item in self.task2vqas[task].values()), start=[])
+            self.items = list(itertools.chain.from_iterable(
+                elem_task_data for task in dataset_meta.keys() for elem_task_data in self.task2vqas[task].values()
+            ))
             random.shuffle(self.items)
+            self.lazy_offsets = np.cumsum([0] + [reader.num_units() for reader in self.lazy_readers.values()])
+            if self.lazy_readers:
+                rank0_print(f"{int(self.lazy_offsets[-1])} items of tasks {list(self.lazy_readers)} are created on the fly.")
         
+        if grouping and grouping.get("enable", True):
+            self.items = self.group_items_by_image(grouping.get("max_len"), grouping.get("max_items_per_group", 8))
+            random.shuffle(self.items)
+        
+        if splitting and splitting.get("enable", True):
+            self.items, self.item_lengths = self.split_long_items(splitting.get("max_len"))
+            if self.tiling is not None:
+                self.item_lengths = self.fit_item_lengths(self.item_lengths)
+        
+        if self.feature_store is not None:
+            num_missing = sum(item["images"][0] not in self.feature_store for item in self.items)
+            if num_missing > 0:
+                raise ValueError(f"ViT features of {num_missing} images are missing, please extract them with edge_dataset.feature_store first!")
+    
     def __len__(self):
-        return len(self.items)
+        if self.packs is not None:
+            return len(self.packs)
+        return len(self.items) + int(self.lazy_offsets[-1])
     
     def __getitem__(self, idx):
-        item = self.items[idx]
+        if self.packs is not None:
+            sample = self.get_packed_item(self.packs[idx])
+            # a pack whose items all lost their image spans to truncation is replaced by the next one
+            return sample if sample is not None else self[(idx + 1) % len(self)]
+        if idx < len(self.items):
+            item = self.items[idx]
+            input_id, target = self.get_tokens(item)
+        else:
+            # items created on the fly differ every epoch, so they are kept out of the token cache
+            item = self.create_lazy_item(idx - len(self.items))
+            input_id, target = self.tokenize_item(item, self.tokenizer)
+            input_id, target = input_id[:self.max_len], target[:self.max_len]
+        image_input = self.read_image_input(item["images"][0], self.get_max_windows(item))
+        if self.tiling is not None:
+            tokens = self.fit_image_spans(input_id, target, [len(image_input)])
+            if tokens is None:
+                # the image span of the item is cut by truncation, so the next item is taken instead
+                return self[(idx + 1) % len(self)]
+            input_id, target = tokens
+        if self.pad_to_max_len:
+            input_id, target = self.pad_tokens(input_id, target, self.pad_token_id)
+        # otherwise left to be padded to the longest sequence in the batch by EDGEDataCollator
+        input_ids = torch.tensor(input_id, dtype=torch.int)
+        labels = torch.tensor(target, dtype=torch.int)
+        sample = dict(
+            input_ids=input_ids,
+            labels=labels,
+            attention_mask=input_ids.ne(self.pad_token_id),
+        )
+        sample[self.image_key] = image_input
+        if self.tiling is not None:
+            sample["num_tiles"] = torch.tensor([len(image_input)], dtype=torch.long)
+        return sample
+    
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+    
+    def create_lazy_item(self, lazy_idx):
+        """
+        Create the item of a unit of a lazy task with an RNG seeded by (seed, epoch, index), so that every epoch draws
+        fresh prompts, elements and points, reproducibly in whichever dataloader worker. A unit without any QA is
+        replaced by the next ones of its task.
+        """
+        task_idx = int(np.searchsorted(self.lazy_offsets, lazy_idx, side="right")) - 1
+        task, reader = list(self.lazy_readers.items())[task_idx]
+        num_units = int(self.lazy_offsets[task_idx + 1] - self.lazy_offsets[task_idx])
+        unit_idx = lazy_idx - int(self.lazy_offsets[task_idx])
+        rng_state = random.getstate()
+        try:
+            for i in range(num_units):
+                random.seed(f"{self.seed}-{self.epoch}-{lazy_idx}-{i}")
+                item = reader.create_unit_item((unit_idx + i) % num_units)
+                if item is not None:
+                    self.fill_img_path({task: {item["id"]: [item]}})
+                    return item
+        finally:
+            random.setstate(rng_state)
+        raise ValueError(f"No QA can be created from any unit of task {task}!")
+    
+    def read_image_input(self, img_path, max_windows=None):
+        """
+        Image tiles of (5, C, H, W) in the dtype of `image_transport`, the resized image of (H, W, C) in uint8 to be tiled
+        on the device, or the cached ViT trunk outputs of (5, vit_seq_len, width) of the tiles. With adaptive tiling,
+        the (n_tiles, C, H, W) tiles of the grid of at most `max_windows` windows chosen for the image.
+        """
+        if self.feature_store is not None:
+            return self.feature_store.get(img_path)
+        if max_windows is not None:
+            tiles = self.split_resized_img(image_processing.decode_tiled(img_path, max_windows))
+            return tiles.to(torch.bfloat16) if self.image_transport == "bf16" else tiles
+        img = self.image_cache.get(img_path) if self.image_cache is not None else self.read_resized_img(img_path)
+        return self.transport_resized_img(img, self.image_transport)
+    
+    def get_max_windows(self, item):
+        """Window budget of the task of an item under adaptive tiling, or None without it."""
+        if self.tiling is None:
+            return None
+        task = item.get("id", "").split(";")[0]
+        return self.tiling.get("task_max_windows", {}).get(task, self.tiling.get("max_windows", 4))
+    
+    def get_num_tiles(self, item):
+        """Number of tiles of the image of an item under adaptive tiling, from its size in the image index or header."""
         img_path = item["images"][0]
-        inputs = self.preprocess([item], self.tokenizer)
-        img_patches = self.read_and_split_img(img_path)
-        return dict(
-            input_ids=inputs["input_ids"][0],
-            labels=inputs["labels"][0],
-            attention_mask=inputs["attention_mask"][0],
-            images=img_patches
+        size = GeneralDataset.image_index.get_size(img_path) if GeneralDataset.image_index is not None else None
+        if size is None:
+            with Image.open(img_path) as img:
+                size = img.size
+        return image_processing.count_tiles(*size, self.get_max_windows(item))
+    
+    def fit_item_lengths(self, lengths):
+        """
+        Lengths of items measured with the fixed image span, changed to those of `fit_image_spans` under adaptive
+        tiling. Items share images, so the number of tiles is worked out once per image and budget.
+        """
+        num_tiles = {}
+        fitted = []
+        for item, length in zip(tqdm(self.items, desc="Fitting item lengths to tiling"), lengths):
+            key = (item["images"][0], self.get_max_windows(item))
+            if key not in num_tiles:
+                num_tiles[key] = self.get_num_tiles(item)
+            fitted.append(min(length + (num_tiles[key] - self.fixed_num_tiles) * self.tile_seq_len, self.max_len))
+        return fitted
+    
+    def fit_image_spans(self, input_id, target, num_tiles):
+        """
+        Input ids and labels with the image-pad span of every image, padded to a fixed length by the tokenizer, resized
+        to `tile_seq_len` tokens for each of the `num_tiles` tiles of the image, and truncated to max_len again. The
+        image url at the start of a span is kept. None if a span does not end within max_len, since its image would
+        have no place for its tiles.
+        """
+        img_start_id, img_end_id, img_pad_id = self.tokenizer.img_start_id, self.tokenizer.img_end_id, self.tokenizer.img_pad_id
+        starts = [i for i, token_id in enumerate(input_id) if token_id == img_start_id]
+        assert len(starts) == len(num_tiles), f"{len(starts)} image spans for {len(num_tiles)} images!"
+        # from the last span, so that the positions of the previous ones stay valid
+        for start, n in reversed(list(zip(starts, num_tiles))):
+            span_len = n * self.tile_seq_len
+            if img_end_id not in input_id[start:] or start + span_len + 1 >= self.max_len:
+                return None
+            end = input_id.index(img_end_id, start)
+            url = input_id[start + 1:end]
+            url = url[:url.index(img_pad_id)] if img_pad_id in url else url
+            assert len(url) <= span_len, f"The image url does not fit in the span of {n} tiles!"
+            input_id = input_id[:start + 1] + url + [img_pad_id] * (span_len - len(url)) + input_id[end:]
+            target = target[:start + 1] + [self.ignore_token_id] * span_len + target[end:]
+        return input_id[:self.max_len], target[:self.max_len]
+    
+    def get_tokens(self, item):
+        """Input ids and labels of an item truncated to max_len, read from the token cache if there is one."""
+        if self.token_cache is not None:
+            return self.token_cache.get(item)
+        input_id, target = self.tokenize_item(item, self.tokenizer)
+        return input_id[:self.max_len], target[:self.max_len]
+    
+    def get_template_overheads(self):
+        """Numbers of tokens taken by an image block and by the system message in the chat template."""
+        def num_tokens(contents):
+            messages = [{"role": role, "content": content} for content, role in zip(contents, ["user", "assistant"] * 2)]
+            return len(self.tokenize_item({"messages": messages}, self.tokenizer)[0])
+        img_overhead = num_tokens(["Picture 1: <img>x.png</img>\n", ""]) - num_tokens(["", ""])
+        turn_overhead = num_tokens(["", "", "", ""]) - num_tokens(["", ""])
+        system_len = num_tokens(["", ""]) - turn_overhead
+        return img_overhead, system_len
+    
+    @staticmethod
+    def merge_items(items):
+        """Merge items about the same image into one multi-turn item, in the message style of the first item."""
+        message_tag = "messages" if "messages" in items[0] else "conversations"
+        role_tag, content_tag = ("role", "content") if "messages" in items[0] else ("from", "value")
+        img_prefix = f"Picture 1: <img>{items[0]['images'][0]}</img>\n"
+        messages, turn_ids = [], []
+        for i, item in enumerate(items):
+            if message_tag in item:
+                item_messages = [dict(message) for message in item[message_tag]]
+            else:
+                # an item of the other style, whose roles are named alike
+                item_role_tag, item_content_tag = ("role", "content") if "messages" in item else ("from", "value")
+                item_messages = [{role_tag: message[item_role_tag], content_tag: message[item_content_tag]}
+                                 for message in item["messages" if "messages" in item else "conversations"]]
+            # the image is given only once, at the beginning of the merged conversation
+            if i > 0 and item_messages[0][content_tag].startswith(img_prefix):
+                item_messages[0][content_tag] = item_messages[0][content_tag][len(img_prefix):]
+            messages += item_messages
+            turn_ids += item.get("turn_ids", [item["id"]] * (len(item_messages) // 2))
+        return {"id": items[0]["id"], message_tag: messages, "images": items[0]["images"], "turn_ids": turn_ids}
+    
+    def group_items_by_image(self, max_len=None, max_items_per_group=8):
+        """
+        Merge the items about the same image into multi-turn items of at most `max_len` tokens, so that a screenshot
+        is encoded once per sample instead of once per task. The task id of every QA turn is kept in `turn_ids`.
+        """
+        max_len = max_len or self.max_len
+        img_overhead, system_len = self.get_template_overheads()
+        img2items = defaultdict(list)
+        for item in self.items:
+            img2items[item["images"][0]].append(item)
+        
+        grouped_items = []
+        task2turns = defaultdict(int)
+        for img_items in tqdm(img2items.values(), desc="Grouping items by image"):
+            random.shuffle(img_items)
+            group, group_len = [], 0
+            for item in img_items:
+                length = len(self.get_tokens(item)[0])
+                merged_len = length - img_overhead - system_len
+                if group and (group_len + merged_len > max_len or len(group) == max_items_per_group):
+                    grouped_items.append(self.merge_items(group) if len(group) > 1 else group[0])
+                    group, group_len = [], 0
+                group_len += merged_len if group else length
+                group.append(item)
+                task2turns[item["id"]] += GeneralDataset.get_num_qas_from_item(item)
+            grouped_items.append(self.merge_items(group) if len(group) > 1 else group[0])
+        
+        message = f"Grouped {len(self.items)} items about {len(img2items)} images into {len(grouped_items)} items, with turns of"
+        for task_id, num_turns in sorted(task2turns.items()):
+            message += f"\n\t{task_id}: {num_turns}"
+        rank0_print(message)
+        return grouped_items
+    
+    def split_item(self, item, max_len, img_overhead, system_len):
+        """
+        Split the turns of an item into consecutive items of at most `max_len` tokens where possible, the image being
+        given again at the beginning of every further item. A turn longer than `max_len` on its own makes an item of its
+        own, which is left to truncation.
+        """
+        message_tag = "messages" if "messages" in item else "conversations"
+        content_tag = "content" if "messages" in item else "value"
+        messages = item[message_tag]
+        turn_lens = [
+            len(self.tokenize_item({message_tag: messages[i:i + 2]}, self.tokenizer)[0]) - system_len
+            for i in range(0, len(messages), 2)
+        ]
+        bounds, start, split_len = [], 0, system_len
+        for turn, turn_len in enumerate(turn_lens):
+            if turn > start and split_len + turn_len > max_len:
+                bounds.append((start, turn))
+                start, split_len = turn, system_len + img_overhead
+            split_len += turn_len
+        bounds.append((start, len(turn_lens)))
+        
+        img_prefix = f"Picture 1: <img>{item['images'][0]}</img>\n"
+        turn_ids = item.get("turn_ids")
+        split_items = []
+        for start, end in bounds:
+            split_messages = [dict(message) for message in messages[2 * start:2 * end]]
+            if not split_messages[0][content_tag].startswith(img_prefix):
+                split_messages[0][content_tag] = img_prefix + split_messages[0][content_tag]
+            split_item = {**item, message_tag: split_messages}
+            if turn_ids is not None:
+                split_item["id"], split_item["turn_ids"] = turn_ids[start], turn_ids[start:end]
+            split_items.append(split_item)
+        return split_items
+    
+    def get_answer_start(self, item):
+        """Position of the first answer token of an item in the chat template."""
+        message_tag = "messages" if "messages" in item else "conversations"
+        content_tag = "content" if "messages" in item else "value"
+        prompt = [item[message_tag][0], {**item[message_tag][1], content_tag: ""}]
+        # the empty answer is followed by <|im_end|> and a new line
+        return len(self.tokenize_item({message_tag: prompt}, self.tokenizer)[0]) - 1 - len(self.tokenized["new_line"])
+    
+    def split_long_items(self, max_len=None):
+        """
+        Split the items longer than `max_len` tokens in the chat template at turn boundaries, instead of losing their
+        trailing turns to truncation. Split items that would have no supervised token left after truncation are dropped.
+        Returns the items with their lengths, and reports per task how many items were split, truncated or dropped.
+        """
+        max_len = max_len or self.max_len
+        img_overhead, system_len = self.get_template_overheads()
+        items, lengths = [], []
+        task2stats = defaultdict(lambda: defaultdict(int))
+        for item in tqdm(self.items, desc="Splitting long items"):
+            stats = task2stats[item.get("id", "")]
+            stats["items"] += 1
+            length = len(self.tokenize_item(item, self.tokenizer)[0])
+            if length <= max_len:
+                items.append(item)
+                lengths.append(length)
+                continue
+            stats["long"] += 1
+            for split_item in self.split_item(item, max_len, img_overhead, system_len):
+                length = len(self.tokenize_item(split_item, self.tokenizer)[0])
+                if length > max_len:
+                    # the prompt alone of a single turn may not fit
+                    if self.get_answer_start(split_item) >= max_len:
+                        stats["dropped_turns"] += GeneralDataset.get_num_qas_from_item(split_item)
+                        continue
+                    stats["truncated"] += 1
+                stats["splits"] += 1
+                items.append(split_item)
+                lengths.append(min(length, max_len))
+        
+        num_long = sum(stats["long"] for stats in task2stats.values())
+        message = f"Split {num_long} of {len(self.items)} items longer than {max_len} tokens into {len(items) - len(self.items) + num_long} items"
+        message += ", with long items / items, split items (truncated), dropped turns of"
+        for task_id, stats in sorted(task2stats.items()):
+            if stats["long"]:
+                message += f"\n\t{task_id}: {stats['long']} / {stats['items']}, {stats['splits']} ({stats['truncated']}), {stats['dropped_turns']}"
+        rank0_print(message)
+        return items, lengths
+    
+    def get_task_pools(self):
+        """
+        Sample indices of every task, i.e. the config key before `;` in item ids; a grouped item counts for the task of
+        its first turn, and the units of a lazy task make up its pool.
+        """
+        assert self.packs is None, "Packed samples do not belong to single tasks!"
+        if isinstance(self.items, ItemStore):
+            task_pools = defaultdict(list)
+            for task_id, task_name in enumerate(self.items.task_names):
+                task_pools[task_name.split(";")[0]].append(np.flatnonzero(self.items.task_ids == task_id))
+            task_pools = {task: np.concatenate(pools) for task, pools in task_pools.items()}
+        else:
+            task_pools = defaultdict(list)
+            for idx, item in enumerate(self.items):
+                task_pools[item.get("id", "").split(";")[0]].append(idx)
+            task_pools = {task: np.array(pool, dtype=np.int64) for task, pool in task_pools.items()}
+        for task_idx, task in enumerate(self.lazy_readers):
+            start, end = len(self.items) + self.lazy_offsets[task_idx:task_idx + 2]
+            task_pools[task] = np.arange(start, end, dtype=np.int64)
+        return task_pools
+    
+    def get_item_lengths(self):
+        if self.item_lengths is None:
+            self.item_lengths = []
+            for item in tqdm(self.items, desc="Measuring item lengths"):
+                if self.token_cache is not None:
+                    self.item_lengths.append(self.token_cache.get_length(item))
+                else:
+                    self.item_lengths.append(len(self.get_tokens(item)[0]))
+            if self.tiling is not None:
+                self.item_lengths = self.fit_item_lengths(self.item_lengths)
+        return self.item_lengths
+    
+    def get_lengths(self):
+        """Token length of every sample (item or pack) of this dataset, before padding."""
+        assert not self.lazy_readers, "Lengths of items created on the fly are unknown!"
+        item_lengths = self.get_item_lengths()
+        if self.packs is None:
+            return item_lengths
+        if self.pad_to_max_len:
+            return [self.pack_len] * len(self.packs)
+        return [sum(item_lengths[idx] for idx in pack) for pack in self.packs]
+    
+    def pack_items(self, pack_len, max_items_per_pack=8):
+        """
+        Greedily group consecutive (already shuffled) items into packs of at most `pack_len` tokens.
+        Each item keeps its own image block, and is attended to separately via position resets.
+        """
+        assert pack_len >= self.max_len, f"pack max_len ({pack_len}) must not be shorter than model_max_length ({self.max_len})!"
+        lengths = self.get_item_lengths()
+        packs = []
+        pack, pack_tokens = [], 0
+        for idx, length in enumerate(lengths):
+            if pack and (pack_tokens + length > pack_len or len(pack) == max_items_per_pack):
+                packs.append(pack)
+                pack, pack_tokens = [], 0
+            pack.append(idx)
+            pack_tokens += length
+        if pack:
+            packs.append(pack)
+        
+        num_tokens = sum(lengths)
+        rank0_print(
+            f"Packed {len(lengths)} items into {len(packs)} sequences of {pack_len} tokens. "
+            f"Non-padding ratio: {num_tokens / (len(lengths) * self.max_len):.2%} unpacked -> "
+            f"{num_tokens / (len(packs) * pack_len):.2%} packed."
         )
+        return packs
+    
+    def get_packed_item(self, pack):
+        input_ids, labels, position_ids, images = [], [], [], []
+        for idx in pack:
+            item = self.items[idx]
+            input_id, target = self.get_tokens(item)
+            image_input = self.read_image_input(item["images"][0], self.get_max_windows(item))
+            if self.tiling is not None:
+                tokens = self.fit_image_spans(input_id, target, [len(image_input)])
+                if tokens is None:
+                    # an item whose image span is cut by truncation is left out of the pack
+                    continue
+                input_id, target = tokens
+            images.append(image_input)
+            # The first token of a segment must not be predicted from the end of the previous one
+            target[0] = self.ignore_token_id
+            input_ids += input_id
+            labels += target
+            position_ids += list(range(len(input_id)))
+        if not images:
+            return None
+        
+        # Padding forms a trailing segment of its own, so that it never attends to real tokens
+        num_pad = self.pack_len - len(input_ids) if self.pad_to_max_len else 0
+        input_ids += [self.pad_token_id] * num_pad
+        labels += [self.ignore_token_id] * num_pad
+        position_ids += list(range(num_pad))
+        
+        input_ids = torch.tensor(input_ids, dtype=torch.int)
+        sample = dict(
+            input_ids=input_ids,
+            labels=torch.tensor(labels, dtype=torch.int),
+            attention_mask=input_ids.ne(self.pad_token_id),
+            position_ids=torch.tensor(position_ids, dtype=torch.long),
+        )
+        if self.tiling is not None:
+            # tiles of all segments one after another, with their numbers per image
+            sample[self.image_key] = torch.cat(images)
+            sample["num_tiles"] = torch.tensor([len(tiles) for tiles in images], dtype=torch.long)
+        else:
+            sample[self.image_key] = torch.stack(images)
+        return sample
         
     @staticmethod
-    def create_vqa_text_dataset(dataset_meta):
+    def create_vqa_text_dataset(dataset_meta, num_workers=1, anno_index_dir=None, image_index_path=None):
+        """
+        Read the annotations of every task and create its QAs. With `num_workers > 1`, annotation directories are
+        parsed by a process pool, and the QAs of the tasks are created in parallel. Either way, every task creates its
+        QAs with an RNG seeded from the global one, so that the result only depends on the global seed, not on
+        `num_workers`. With `anno_index_dir`, the filtered pages of annotation directories are kept in persistent
+        indexes there, and only new or modified pages are parsed.
+        
+        Tasks with `"lazy": true` create no QA here. Their readers, holding only the compact annotations, are returned
+        along with the QAs of the other tasks, to create items on the fly (see `create_lazy_item`).
+        
+        Images are looked up in directory listings (see FileIndex), persisted under `anno_index_dir` too, and items of
+        missing images are skipped and reported per task, as are those of the images found invalid by the ImageIndex
+        at `image_index_path`.
+        """
+        EDGEAnnotationReader.num_workers = num_workers
+        EDGEAnnotationReader.index_dir = anno_index_dir
+        FileIndex.cache_dir = os.path.join(anno_index_dir, "listings") if anno_index_dir else None
+        GeneralDataset.image_index = None
+        if image_index_path:
+            assert os.path.exists(image_index_path), f"Image index {image_index_path} not found, please build it with edge_dataset.image_index first!"
+            GeneralDataset.image_index = ImageIndex(image_index_path)
+            rank0_print(f"Image index {image_index_path}: {len(GeneralDataset.image_index.invalid_paths)} of {len(GeneralDataset.image_index)} images invalid.")
         task_data_readers = {}
+        lazy_readers = {}
         for task, task_meta in dataset_meta.items():
+            lazy = task_meta.get("lazy", False)
             task_data_reader = GeneralDataset.create_vqa_text_dataset(task, task_meta)
-            task_data_readers[task] = task_data_reader
             rank0_print(f"Task **{task}**: {task_data_reader.read_done_message()}")
+            if lazy:
+                assert task_data_reader.lazy_supported, f"QAs of task {task} can not be created on the fly!"
+                lazy_readers[task] = task_data_reader
+            else:
+                task_data_readers[task] = task_data_reader
+
+        # every task draws from an RNG of its own, seeded from the global one, whether it runs in a pool or not
+        task_seeds = [(task, random.randrange(2**32)) for task in task_data_readers.keys()]
+        if num_workers > 1 and len(task_data_readers) > 1:
+            global _qa_data_readers
+            _qa_data_readers = task_data_readers
+            with Pool(min(num_workers, len(task_seeds))) as pool:
+                task_qa_data = pool.map(_create_qa_data, task_seeds, chunksize=1)
+            _qa_data_readers = None
+            for (task, _), (qa_data, skipped_images) in zip(task_seeds, task_qa_data):
+                task_data_readers[task].qa_data = qa_data
+                task_data_readers[task].skipped_images = skipped_images
+        else:
+            # the global stream is left where the pool leaves it
+            rng_state = random.getstate()
+            for task, seed in task_seeds:
+                random.seed(seed)
+                task_data_readers[task].create_qa_data()
+            random.setstate(rng_state)
         
         num_images = 0
         num_total = 0
-        task2vqas = {}
+        num_skipped = 0
+        task2vqas = {task: {} for task in lazy_readers}
         for task, task_data_reader in task_data_readers.items():
-            task_data_reader.create_qa_data()
             task2vqas[task] = task_data_reader.qa_data
             task_num_images, task_num_total = task_data_reader.get_all_count()
             num_images += task_num_images
             num_total += task_num_total
+            num_skipped += sum(len(skipped_images) for skipped_images in task_data_reader.skipped_images.values())
             rank0_print(f"Task **{task}{task_data_reader.elem_tasks}**: {task_data_reader.create_done_message()}")
         
-        rank0_print(f"Successfully create {num_images} images ({num_total} QAs) in total.")
-        return task2vqas
+        rank0_print(f"Successfully create {num_images} images ({num_total} QAs) in total, skipping {num_skipped} missing or invalid images.")
+        return task2vqas, lazy_readers
     
     @staticmethod
     def fill_img_path(task2vqas):
@@ -706,49 +1287,47 @@ class EDGETensorDataset(Dataset):
         rank0_print(f"Successfully dump {len(self.items)} items, with {num_encode_error} errors.")
 
     def load_jsonl_items(self, items_filepath):
-        rank0_print("Loading data items ...", end="")
-        items = []
+        """Items of a jsonl file, parsed lazily through an offset index (see ItemStore)."""
         assert items_filepath.endswith("jsonl")
-        num_total = 0
-        with open(items_filepath, 'r', encoding='utf-8') as f:
-            for line in f:
-                if line.strip():
-                    item = json.loads(line)
-                    task, elem_task = item["id"].split(";")
-                    self.task2vqas[task][elem_task].append(item)
-                    items.append(item)
-                    num_total += GeneralDataset.get_num_qas_from_item(items[-1])
-        rank0_print(f"Done!\nSuccessfully read {len(items)} items ({num_total} QAs) in total.")
-        return items
+        return ItemStore(items_filepath)
     
     def get_raw_qa(self, idx, task=None, elem_task=None):
         if task is None or elem_task is None:
             return self.items[idx]
+        if isinstance(self.items, ItemStore):
+            return self.items.get_task_item(f"{task};{elem_task}", idx)
         return self.task2vqas[task][elem_task][idx]
 
-    @staticmethod
-    def sliding_window(img, window_size, stride):
-        _, h, w = img.shape
-        window_rows = (h - window_size[0]) // stride + 1
-        window_cols = (w - window_size[1]) // stride + 1
-        windows = [
-            img[:, i*stride:i*stride+window_size[0],  j*stride:j*stride+window_size[1]]
-            for i in range(window_rows) for j in range(window_cols)
-        ]
-        return windows
+    @classmethod
+    def read_resized_img(cls, img_path):
+        """Decode an image and resize it to 896x896, as a uint8 array of (H, W, C)."""
+        return image_processing.decode_resized(img_path)
     
     @classmethod
-    def read_and_split_img(cls, img_path):
-        with Image.open(img_path) as img:
-            img = img.convert("RGB")
-            img = cls.image_transform(img)
-            windows = cls.sliding_window(img, window_size=(448, 448), stride=448)
-            img_448 = F.interpolate(img.unsqueeze(0), size=(448, 448), mode='bicubic').squeeze(0)
-            img_patches = torch.stack(windows + [img_448])
-        return img_patches
+    def split_resized_img(cls, img):
+        """Tiles of (5, C, 448, 448) of a resized image, or of (B, 5, C, 448, 448) of a batch of them."""
+        return image_processing.split_resized(img)
     
     @classmethod
-    def preprocess(cls, items, tokenizer, max_len=2048):
+    def transport_resized_img(cls, img, image_transport="float32"):
+        """
+        Image input of a resized uint8 image, as shipped from the dataloader workers: float32 or bf16 tiles, which the
+        ViT casts to bf16 anyway, or the uint8 image itself, 5x smaller than float32 tiles, which MonkeyModel tiles and
+        normalizes on the device.
+        """
+        if image_transport == "uint8":
+            # copied, as cached images are read-only memory maps
+            return torch.tensor(img)
+        tiles = cls.split_resized_img(img)
+        return tiles.to(torch.bfloat16) if image_transport == "bf16" else tiles
+    
+    @classmethod
+    def read_and_split_img(cls, img_path, image_cache=None):
+        img = image_cache.get(img_path) if image_cache is not None else cls.read_resized_img(img_path)
+        return cls.split_resized_img(img)
+    
+    @classmethod
+    def tokenize_item(cls, item, tokenizer):
         if not cls.tokenized:
             cls.tokenized ={
                 "new_line": tokenizer("\n").input_ids,
@@ -764,7 +1343,7 @@ class EDGETensorDataset(Dataset):
         nl_tokens = cls.tokenized["new_line"]
         _system = cls.tokenized["system"] + nl_tokens
         
-        if "messages" in items[0]:
+        if "messages" in item:
             role_tag = "role"
             content_tag = "content"
             message_tag = "messages"
@@ -773,35 +1352,44 @@ class EDGETensorDataset(Dataset):
             content_tag = "value"
             message_tag = "conversations"
         
-        
         # Apply prompt templates
+        assert item[message_tag][0][role_tag] == "user"
+
+        input_id, target = [], []
+        system = [im_start] + _system + cls.tokenized["system_message"] + [im_end] + nl_tokens
+        input_id += system
+        target += [im_start] + [cls.ignore_token_id] * (len(system)-3) + [im_end] + nl_tokens
+        assert len(input_id) == len(target)
+        for message in item[message_tag]:
+            role = cls.roles[message[role_tag]]
+            _input_id = cls.tokenized[role] + nl_tokens + \
+                tokenizer(message[content_tag]).input_ids + [im_end] + nl_tokens
+            input_id += _input_id
+            if role == '<|im_start|>user':
+                _target = [im_start] + [cls.ignore_token_id] * (len(_input_id)-3) + [im_end] + nl_tokens
+            elif role == '<|im_start|>assistant':
+                _target = [im_start] + [cls.ignore_token_id] * len(cls.tokenized[role]) + \
+                    _input_id[len(cls.tokenized[role])+1:-2] + [im_end] + nl_tokens
+            else:
+                raise NotImplementedError
+            target += _target
+        assert len(input_id) == len(target)
+        return input_id, target
+    
+    @classmethod
+    def pad_tokens(cls, input_id, target, pad_token_id, max_len=2048):
+        input_id = input_id + [pad_token_id] * (max_len - len(input_id))
+        target = target + [cls.ignore_token_id] * (max_len - len(target))
+        return input_id[:max_len], target[:max_len]
+    
+    @classmethod
+    def preprocess(cls, items, tokenizer, max_len=2048):
         input_ids, targets = [], []
         for item in items:
-            assert item[message_tag][0][role_tag] == "user"
-
-            input_id, target = [], []
-            system = [im_start] + _system + cls.tokenized["system_message"] + [im_end] + nl_tokens
-            input_id += system
-            target += [im_start] + [cls.ignore_token_id] * (len(system)-3) + [im_end] + nl_tokens
-            assert len(input_id) == len(target)
-            for message in item[message_tag]:
-                role = cls.roles[message[role_tag]]
-                _input_id = cls.tokenized[role] + nl_tokens + \
-                    tokenizer(message[content_tag]).input_ids + [im_end] + nl_tokens
-                input_id += _input_id
-                if role == '<|im_start|>user':
-                    _target = [im_start] + [cls.ignore_token_id] * (len(_input_id)-3) + [im_end] + nl_tokens
-                elif role == '<|im_start|>assistant':
-                    _target = [im_start] + [cls.ignore_token_id] * len(cls.tokenized[role]) + \
-                        _input_id[len(cls.tokenized[role])+1:-2] + [im_end] + nl_tokens
-                else:
-                    raise NotImplementedError
-                target += _target
-            assert len(input_id) == len(target)
-            input_id += [tokenizer.pad_token_id] * (max_len - len(input_id))
-            target += [cls.ignore_token_id] * (max_len - len(target))
-            input_ids.append(input_id[:max_len])
-            targets.append(target[:max_len])
+            input_id, target = cls.tokenize_item(item, tokenizer)
+            input_id, target = cls.pad_tokens(input_id, target, tokenizer.pad_token_id, max_len)
+            input_ids.append(input_id)
+            targets.append(target)
         input_ids = torch.tensor(input_ids, dtype=torch.int)
         targets = torch.tensor(targets, dtype=torch.int)
 
@@ -810,3 +1398,13 @@ class EDGETensorDataset(Dataset):
             labels=targets,
             attention_mask=input_ids.ne(tokenizer.pad_token_id),
         )
+
+
+_qa_data_readers = None
+
+def _create_qa_data(task_seed):
+    task, seed = task_seed
+    random.seed(seed)
+    task_data_reader = _qa_data_readers[task]
+    task_data_reader.create_qa_data()
+    return task_data_reader.qa_data, task_data_reader.skipped_images
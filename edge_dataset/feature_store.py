@@ -0,0 +1,189 @@
+import os
+import json
+import glob
+import uuid
+import socket
+import hashlib
+import argparse
+import numpy as np
+from tqdm import tqdm
+
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from monkey_model.image_processing import split_resized
+from utils.utils_ddp import rank0_print
+
+
+class ViTFeatureStore:
+    """
+    Sharded store of the outputs of the frozen ViT trunk (the tokens fed into `attn_pool`), one fixed-size record of
+    (5, vit_seq_len, width) per image. Records are kept as int8 with a float32 absmax scale per token by default, 8.5 MB
+    per image at (5, 1024, 1664), less than the 12 MB of float32 tiles they replace, or as bf16/fp16 at 17 MB, which
+    only pays off when the trunk's compute, not data loading, is the bottleneck. The pooled features can not be stored
+    instead, as `attn_pool` is trained.
+    Like TokenCache, every writing process appends to its own shard and offset index, keyed by the hash of the image path.
+    """
+    index_dtype = np.dtype([("key", "S32"), ("offset", "<i8")])
+
+    def __init__(self, store_dir, dtype="int8", feature_shape=(5, 1024, 1664)):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        meta_path = os.path.join(store_dir, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        else:
+            meta = dict(dtype=dtype, feature_shape=list(feature_shape))
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+        self.dtype = meta["dtype"]
+        self.feature_shape = tuple(meta["feature_shape"])
+        assert self.dtype in {"bf16", "fp16", "int8"}, f"Invalid feature dtype: {self.dtype}!"
+
+        num_tokens = int(np.prod(self.feature_shape[:-1]))
+        num_values = num_tokens * self.feature_shape[-1]
+        if self.dtype == "int8":
+            self.record_bytes = num_tokens * 4 + num_values
+        else:
+            self.record_bytes = num_values * 2
+
+        self.shards = []
+        self.index = {}
+        self.writer = None
+        self.writer_pid = None
+        self.load_index()
+
+    def load_index(self):
+        for index_path in sorted(glob.glob(os.path.join(self.store_dir, "*.idx"))):
+            with open(index_path, "rb") as f:
+                buffer = f.read()
+            records = np.frombuffer(buffer[:len(buffer) - len(buffer) % self.index_dtype.itemsize], dtype=self.index_dtype)
+            shard = len(self.shards)
+            self.shards.append([index_path[:-4] + ".bin", None])
+            self.index.update((key, (shard, int(offset))) for key, offset in zip(records["key"].tolist(), records["offset"].tolist()))
+        rank0_print(f"ViT feature store {self.store_dir}: {len(self.index)} images ({self.dtype}) in {len(self.shards)} shards.")
+
+    @staticmethod
+    def get_key(img_path):
+        return hashlib.md5(img_path.encode("utf-8")).hexdigest().encode("ascii")
+
+    def __contains__(self, img_path):
+        return self.get_key(img_path) in self.index
+
+    def encode(self, features):
+        features = features.detach().float().cpu()
+        if self.dtype == "int8":
+            scales = features.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / 127
+            values = torch.round(features / scales).clamp(-127, 127).to(torch.int8)
+            return scales.numpy().astype(np.float32).tobytes() + values.numpy().tobytes()
+        if self.dtype == "bf16":
+            return features.to(torch.bfloat16).view(torch.int16).numpy().tobytes()
+        return features.to(torch.float16).numpy().tobytes()
+
+    def decode(self, buffer):
+        if self.dtype == "int8":
+            num_scale_bytes = int(np.prod(self.feature_shape[:-1])) * 4
+            scales = torch.from_numpy(buffer[:num_scale_bytes].view(np.float32).copy())
+            values = torch.from_numpy(buffer[num_scale_bytes:].view(np.int8).copy())
+            features = values.view(self.feature_shape).float() * scales.view(*self.feature_shape[:-1], 1)
+            return features.to(torch.bfloat16)
+        if self.dtype == "bf16":
+            return torch.from_numpy(buffer.view(np.int16).copy()).view(torch.bfloat16).view(self.feature_shape)
+        return torch.from_numpy(buffer.view(np.float16).copy()).view(self.feature_shape)
+
+    def get(self, img_path):
+        key = self.get_key(img_path)
+        if key not in self.index:
+            raise KeyError(f"ViT features of {img_path} not found in {self.store_dir}!")
+        shard, offset = self.index[key]
+        shard_path, data = self.shards[shard]
+        if data is None or len(data) < offset + self.record_bytes:
+            data = np.memmap(shard_path, dtype=np.uint8, mode="r")
+            self.shards[shard][1] = data
+        return self.decode(data[offset:offset + self.record_bytes])
+
+    def put(self, img_path, features):
+        assert tuple(features.shape) == self.feature_shape, f"{tuple(features.shape)} != {self.feature_shape}"
+        if self.writer_pid != os.getpid():
+            name = f"{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+            shard_path = os.path.join(self.store_dir, name + ".bin")
+            self.writer = (open(shard_path, "ab"), open(os.path.join(self.store_dir, name + ".idx"), "ab"), len(self.shards))
+            self.writer_pid = os.getpid()
+            self.shards.append([shard_path, None])
+
+        shard_file, index_file, shard = self.writer
+        key = self.get_key(img_path)
+        offset = shard_file.tell()
+        shard_file.write(self.encode(features))
+        shard_file.flush()
+        index_file.write(np.array([(key, offset)], dtype=self.index_dtype).tobytes())
+        index_file.flush()
+        self.index[key] = (shard, offset)
+
+
+class ImageTilesDataset(Dataset):
+    def __init__(self, img_paths, read_fn):
+        self.img_paths = img_paths
+        self.read_fn = read_fn
+
+    def __len__(self):
+        return len(self.img_paths)
+
+    def __getitem__(self, idx):
+        return self.img_paths[idx], self.read_fn(self.img_paths[idx])
+
+
+@torch.no_grad()
+def extract_features(visual, img_paths, feature_store, read_fn, batch_size=4, num_workers=8):
+    """
+    Run the frozen ViT trunk once for every image missing from the store. `read_fn` gives the resized uint8 image of a
+    path, and every batch is tiled on the device of the trunk at once.
+    """
+    img_paths = [img_path for img_path in sorted(set(img_paths)) if img_path not in feature_store]
+    rank0_print(f"Extracting ViT features of {len(img_paths)} images ...")
+    dataloader = DataLoader(ImageTilesDataset(img_paths, read_fn), batch_size=batch_size, num_workers=num_workers)
+    device = next(visual.parameters()).device
+    for batch_paths, images in tqdm(dataloader):
+        images = split_resized(images.to(device))
+        bs, n_patchs = images.shape[:2]
+        features = visual.forward_trunk(images.flatten(0, 1)).unflatten(0, sizes=(bs, n_patchs))
+        for img_path, image_features in zip(batch_paths, features):
+            feature_store.put(img_path, image_features)
+
+
+if __name__ == "__main__":
+    from monkey_model.modeling_monkey import MonkeyLMHeadModel
+    from monkey_model.configuration_monkey import MonkeyConfig
+    from monkey_model.tokenization_qwen import QWenTokenizer
+    from .dataset import EDGETensorDataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store-dir", type=str, required=True, help="The directory of the ViT feature store.")
+    parser.add_argument("--model", type=str, default="monkey_model")
+    parser.add_argument("--config", type=str, default=None, help="The dataset config to create items from.")
+    parser.add_argument("--items-filepath", type=str, default=None, help="The jsonl file of dumped items.")
+    parser.add_argument("--dtype", type=str, default="int8", choices=["int8", "bf16", "fp16"],
+                        help="int8 takes 8.5 MB per image, bf16/fp16 twice as much.")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--num-workers", type=int, default=8)
+    args = parser.parse_args()
+
+    # launched with torchrun, every process extracts an equal share of the images
+    rank, world_size = int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+
+    tokenizer = QWenTokenizer.from_pretrained(args.model)
+    dataset_meta = None
+    if args.config:
+        with open(args.config) as f:
+            dataset_meta = json.load(f)["train"]
+    dataset = EDGETensorDataset(tokenizer, dataset_meta=dataset_meta, items_filepath=args.items_filepath)
+    img_paths = sorted({item["images"][0] for item in dataset.items})[rank::world_size]
+
+    config = MonkeyConfig.from_pretrained(args.model)
+    model = MonkeyLMHeadModel.from_pretrained(args.model, config=config, torch_dtype=torch.bfloat16, device_map=local_rank)
+    visual = model.transformer.visual.eval()
+    feature_store = ViTFeatureStore(args.store_dir, dtype=args.dtype, feature_shape=(5, 1024, visual.transformer.width))
+    extract_features(visual, img_paths, feature_store, EDGETensorDataset.read_resized_img,
+                     batch_size=args.batch_size, num_workers=args.num_workers)
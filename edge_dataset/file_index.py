@@ -0,0 +1,72 @@
+import os
+import uuid
+import hashlib
+import numpy as np
+
+from utils.utils_ddp import rank0_print
+from .page_store import StringColumn
+
+
+class FileIndex:
+    """
+    Existence of files answered by set lookups in the listings of their directories, so that millions of images cost
+    one `os.scandir` per directory instead of one stat each, which dominates on network filesystems. A directory is
+    listed once per process. With `cache_dir`, listings persist across runs there, along with the mtime of their
+    directory, which changes whenever entries are added or removed, and are listed again only then.
+    """
+    listings = {}
+    cache_dir = None
+
+    @classmethod
+    def exists(cls, path):
+        dir_name, name = os.path.split(path)
+        return name in cls.get_listing(dir_name)
+
+    @classmethod
+    def get_listing(cls, dir_name):
+        # keyed by the path as given, which saves resolving it for every lookup
+        if dir_name not in cls.listings:
+            cls.listings[dir_name] = cls.read_listing(os.path.abspath(dir_name))
+        return cls.listings[dir_name]
+
+    @classmethod
+    def read_listing(cls, dir_key):
+        try:
+            mtime = os.stat(dir_key).st_mtime_ns
+        except OSError:
+            return frozenset()
+        names = cls.load_listing(dir_key, mtime) if cls.cache_dir is not None else None
+        if names is None:
+            with os.scandir(dir_key) as entries:
+                names = frozenset(entry.name for entry in entries)
+            if cls.cache_dir is not None:
+                cls.save_listing(dir_key, mtime, names)
+        return names
+
+    @classmethod
+    def get_cache_path(cls, dir_key):
+        name = hashlib.sha1(dir_key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(cls.cache_dir, f"{os.path.basename(dir_key)}_{name}.npz")
+
+    @classmethod
+    def load_listing(cls, dir_key, mtime):
+        cache_path = cls.get_cache_path(dir_key)
+        if not os.path.exists(cache_path):
+            return None
+        with np.load(cache_path) as columns:
+            if int(columns["mtime"]) != mtime:
+                return None
+            return frozenset(StringColumn(columns["names"], columns["names_offsets"]).tolist())
+
+    @classmethod
+    def save_listing(cls, dir_key, mtime, names):
+        names = StringColumn.from_strings(sorted(names))
+        cache_path = cls.get_cache_path(dir_key)
+        # other ranks may be writing the same listing, the last complete one wins
+        tmp_path = f"{cache_path[:-4]}.{uuid.uuid4().hex[:8]}.tmp.npz"
+        try:
+            os.makedirs(cls.cache_dir, exist_ok=True)
+            np.savez(tmp_path, names=names.buffer, names_offsets=names.offsets, mtime=np.array(mtime))
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            rank0_print(f"Failed to cache the listing of {dir_key}: {e}")
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import argparse
+import numpy as np
+from tqdm import tqdm
+from multiprocessing import Pool
+
+from utils.utils_ddp import rank0_print
+
+
+class ImageCache:
+    """
+    Content-addressed on-disk cache of resized screenshots. Every image is stored as a (H, W, 3) uint8 array in a slot
+    of fixed-size memory-mapped shards, and located through a SQLite index, which also maps each file (by path, mtime and
+    size) to the hash of its content, so that identical screenshots share one slot.
+
+    The total size is capped by `max_bytes`: once all slots are taken, the least recently used one is evicted. A slot
+    is reserved under a pending key before being overwritten, and readers check that the slot still belongs to their
+    key after copying it, so concurrent dataloader workers never get a half-written image. Cache hits only read the
+    index: their accesses are buffered in the process and written in one transaction every `touch_interval` seconds,
+    or along with the next eviction, so that workers do not contend for the write lock on every hit.
+    """
+    slots_per_shard = 256
+    touch_interval = 30
+
+    def __init__(self, cache_dir, load_fn, max_bytes=200 * 1024**3, img_size=(896, 896)):
+        self.cache_dir = cache_dir
+        self.load_fn = load_fn
+        self.img_shape = (img_size[0], img_size[1], 3)
+        self.slot_bytes = int(np.prod(self.img_shape))
+        self.capacity = max(1, int(max_bytes // self.slot_bytes))
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.conn = None
+        self.conn_pid = None
+        self.shards = {}
+        # slot -> (key, time of the last access) of the hits not written to the index yet
+        self.touches = {}
+        self.touch_time = time.time()
+        self.num_hits = self.num_misses = 0
+        rank0_print(f"Image cache {cache_dir}: {self.count()}/{self.capacity} slots used.")
+
+    def get_conn(self):
+        # a SQLite connection must not be shared with the parent process after a fork
+        if self.conn_pid != os.getpid():
+            self.conn = sqlite3.connect(os.path.join(self.cache_dir, "index.db"), timeout=60, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, key TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS slots (key TEXT UNIQUE, slot INTEGER PRIMARY KEY, last_access REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS slots_last_access ON slots (last_access)")
+            self.conn_pid = os.getpid()
+            self.shards = {}
+            self.touches = {}
+        return self.conn
+
+    def count(self):
+        return self.get_conn().execute("SELECT COUNT(*) FROM slots").fetchone()[0]
+
+    def get_shard(self, slot):
+        shard = slot // self.slots_per_shard
+        if shard not in self.shards:
+            shard_path = os.path.join(self.cache_dir, f"shard_{shard:05d}.u8")
+            shard_size = self.slots_per_shard * self.slot_bytes
+            with open(shard_path, "ab") as f:
+                if f.tell() < shard_size:
+                    f.truncate(shard_size)
+            self.shards[shard] = np.memmap(shard_path, dtype=np.uint8, mode="r+", shape=(self.slots_per_shard, *self.img_shape))
+        return self.shards[shard], slot % self.slots_per_shard
+
+    def get_key(self, img_path):
+        stat = os.stat(img_path)
+        conn = self.get_conn()
+        row = conn.execute("SELECT mtime, size, key FROM files WHERE path = ?", (img_path,)).fetchone()
+        if row is not None and row[0] == stat.st_mtime and row[1] == stat.st_size:
+            return row[2]
+        with open(img_path, "rb") as f:
+            key = hashlib.sha1(f.read()).hexdigest()
+        conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (img_path, stat.st_mtime, stat.st_size, key))
+        return key
+
+    def read(self, key):
+        conn = self.get_conn()
+        row = conn.execute("SELECT slot FROM slots WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        slot = row[0]
+        shard, pos = self.get_shard(slot)
+        img = np.array(shard[pos])
+        # the slot may have been evicted and overwritten while being copied
+        row = conn.execute("SELECT key FROM slots WHERE slot = ?", (slot,)).fetchone()
+        if row is None or row[0] != key:
+            return None
+        self.touches[slot] = (key, time.time())
+        if time.time() - self.touch_time > self.touch_interval:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.flush_touches()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return img
+
+    def flush_touches(self):
+        """Write the buffered accesses to the index, within a transaction of the caller."""
+        # a slot evicted since it was read keeps the access time of its new image
+        self.get_conn().executemany(
+            "UPDATE slots SET last_access = MAX(last_access, ?) WHERE slot = ? AND key = ?",
+            [(access_time, slot, key) for slot, (key, access_time) in self.touches.items()],
+        )
+        self.touches = {}
+        self.touch_time = time.time()
+
+    def reserve_slot(self):
+        conn = self.get_conn()
+        pending_key = f"pending:{uuid.uuid4().hex}"
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # so that recently read images are not evicted
+            self.flush_touches()
+            num_slots, max_slot = conn.execute("SELECT COUNT(*), MAX(slot) FROM slots").fetchone()
+            if num_slots < self.capacity:
+                slot = 0 if max_slot is None else max_slot + 1
+                if slot >= self.capacity:
+                    # a gap left behind by a failed insertion
+                    used = {row[0] for row in conn.execute("SELECT slot FROM slots")}
+                    slot = next(i for i in range(self.capacity) if i not in used)
+                conn.execute("INSERT INTO slots VALUES (?, ?, ?)", (pending_key, slot, time.time()))
+            else:
+                slot = conn.execute("SELECT slot FROM slots ORDER BY last_access LIMIT 1").fetchone()[0]
+                conn.execute("UPDATE slots SET key = ?, last_access = ? WHERE slot = ?", (pending_key, time.time(), slot))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return slot
+
+    def write(self, key, img):
+        slot = self.reserve_slot()
+        shard, pos = self.get_shard(slot)
+        shard[pos] = img
+        shard.flush()
+        try:
+            self.get_conn().execute("UPDATE slots SET key = ? WHERE slot = ?", (key, slot))
+        except sqlite3.IntegrityError:
+            # the same image has just been cached by another process
+            self.get_conn().execute("DELETE FROM slots WHERE slot = ?", (slot,))
+
+    def get(self, img_path):
+        """The resized image as a (H, W, 3) uint8 array, decoded and added to the cache on a miss."""
+        key = self.get_key(img_path)
+        img = self.read(key)
+        if img is not None:
+            self.num_hits += 1
+            return img
+        self.num_misses += 1
+        img = self.load_fn(img_path)
+        assert img.shape == self.img_shape and img.dtype == np.uint8
+        self.write(key, img)
+        return img
+
+    def build(self, img_paths, num_workers=1):
+        img_paths = sorted(set(img_paths))
+        rank0_print(f"Caching {len(img_paths)} images ...")
+        if num_workers <= 1:
+            for img_path in tqdm(img_paths):
+                self.get(img_path)
+        else:
+            global _build_cache
+            _build_cache = self
+            with Pool(num_workers) as pool:
+                for _ in tqdm(pool.imap_unordered(_build_one, img_paths, chunksize=16), total=len(img_paths)):
+                    pass
+        rank0_print(f"Done! {self.count()}/{self.capacity} slots used.")
+
+
+_build_cache = None
+
+def _build_one(img_path):
+    if os.path.exists(img_path):
+        _build_cache.get(img_path)
+
+
+if __name__ == "__main__":
+    from monkey_model.tokenization_qwen import QWenTokenizer
+    from .dataset import EDGETensorDataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache-dir", type=str, required=True, help="The directory of the image cache.")
+    parser.add_argument("--config", type=str, default=None, help="The dataset config to create items from.")
+    parser.add_argument("--items-filepath", type=str, default=None, help="The jsonl file of dumped items.")
+    parser.add_argument("--tokenizer", type=str, default="monkey_model")
+    parser.add_argument("--max-size-gb", type=float, default=200, help="The size cap of the cache in GB.")
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    tokenizer = QWenTokenizer.from_pretrained(args.tokenizer)
+    dataset_meta = None
+    if args.config:
+        with open(args.config) as f:
+            dataset_meta = json.load(f)["train"]
+    dataset = EDGETensorDataset(tokenizer, dataset_meta=dataset_meta, items_filepath=args.items_filepath, num_workers=args.num_workers)
+    image_cache = ImageCache(args.cache_dir, EDGETensorDataset.read_resized_img, max_bytes=args.max_size_gb * 1024**3)
+    image_cache.build([item["images"][0] for item in dataset.items], num_workers=args.num_workers)
@@ -0,0 +1,183 @@
+import os
+import copy
+import json
+import uuid
+import argparse
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+from multiprocessing import Pool
+
+from utils.utils_ddp import rank0_print
+from .page_store import StringColumn
+
+
+class ImageIndex:
+    """
+    Index of the images referenced by a dataset, with the file size, dimensions and mode of every image, and the
+    reason it is unusable if it is: an empty or oversized file, a failed decode, dimensions out of range, or an
+    unsupported mode. It is built by a process pool, and saved with the mtime of every image, so that an update only
+    checks new or modified images.
+
+    Dataset construction drops the items of invalid images up front (see `GeneralDataset.add_item`), instead of
+    crashing a dataloader worker hours into training, and readers can get image sizes without opening the files.
+    """
+    min_side = 16
+    max_pixels = 1 << 28
+    max_file_bytes = 64 << 20
+    valid_modes = {"1", "L", "LA", "P", "PA", "RGB", "RGBA", "RGBX", "CMYK", "YCbCr"}
+
+    def __init__(self, path):
+        self.path = path
+        self.paths = []
+        self.mtimes = np.zeros(0, dtype=np.int64)
+        self.file_sizes = np.zeros(0, dtype=np.int64)
+        self.sizes = np.zeros((0, 2), dtype=np.int32)
+        self.modes = []
+        self.errors = []
+        if os.path.exists(path):
+            with np.load(path) as columns:
+                self.paths = StringColumn(columns["paths"], columns["paths_offsets"]).tolist()
+                self.mtimes = columns["mtimes"]
+                self.file_sizes = columns["file_sizes"]
+                self.sizes = columns["sizes"]
+                self.modes = StringColumn(columns["modes"], columns["modes_offsets"]).tolist()
+                self.errors = StringColumn(columns["errors"], columns["errors_offsets"]).tolist()
+        self.path2row = None
+        self.invalid_paths = {path: error for path, error in zip(self.paths, self.errors) if error}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def is_valid(self, img_path):
+        """Whether an image is usable, assumed for images out of the index."""
+        return img_path not in self.invalid_paths
+
+    def get_row(self, img_path):
+        if self.path2row is None:
+            self.path2row = {path: row for row, path in enumerate(self.paths)}
+        return self.path2row.get(img_path)
+
+    def get_size(self, img_path):
+        """(width, height) of an indexed image, or None."""
+        row = self.get_row(img_path)
+        return None if row is None else tuple(self.sizes[row].tolist())
+
+    def get_record(self, row):
+        """(mtime_ns, file_size, width, height, mode, error) of an indexed image."""
+        width, height = self.sizes[row].tolist()
+        return int(self.mtimes[row]), int(self.file_sizes[row]), width, height, self.modes[row], self.errors[row]
+
+    @classmethod
+    def check_image(cls, img_path, mtime=None, file_size=None):
+        """
+        (img_path, mtime_ns, file_size, width, height, mode, error) of an image, with an empty error if it is usable,
+        or None if its mtime and file size are still the given ones.
+        """
+        try:
+            stat = os.stat(img_path)
+        except OSError as e:
+            return img_path, 0, 0, 0, 0, "", f"stat failed: {e}"
+        if stat.st_mtime_ns == mtime and stat.st_size == file_size:
+            return None
+        if stat.st_size == 0 or stat.st_size > cls.max_file_bytes:
+            return img_path, stat.st_mtime_ns, stat.st_size, 0, 0, "", f"file size {stat.st_size} out of range"
+
+        width = height = 0
+        mode = ""
+        try:
+            with Image.open(img_path) as img:
+                (width, height), mode = img.size, img.mode
+                if min(width, height) < cls.min_side or width * height > cls.max_pixels:
+                    raise ValueError(f"dimensions {width}x{height} out of range")
+                if mode not in cls.valid_modes:
+                    raise ValueError(f"unsupported mode {mode}")
+                img.load()
+        except Exception as e:
+            # PIL raises all kinds of errors for broken files
+            return img_path, stat.st_mtime_ns, stat.st_size, width, height, mode, f"{type(e).__name__}: {e}"
+        return img_path, stat.st_mtime_ns, stat.st_size, width, height, mode, ""
+
+    def update(self, img_paths, num_workers=1):
+        """Check the images that are new or modified since they were indexed, and save the index."""
+        img_paths = sorted(set(img_paths))
+        tasks = []
+        for img_path in img_paths:
+            row = self.get_row(img_path)
+            if row is None:
+                tasks.append((img_path, None, None))
+            else:
+                tasks.append((img_path, int(self.mtimes[row]), int(self.file_sizes[row])))
+
+        rank0_print(f"Checking {len(tasks)} images ...")
+        if num_workers > 1:
+            with Pool(num_workers) as pool:
+                results = list(tqdm(pool.imap(_check_image, tasks, chunksize=64), total=len(tasks)))
+        else:
+            results = [_check_image(task) for task in tqdm(tasks)]
+
+        records = {}
+        for img_path, result in zip(img_paths, results):
+            records[img_path] = result[1:] if result is not None else self.get_record(self.get_row(img_path))
+        # images referenced before are kept, as other configs may still use them
+        for row, img_path in enumerate(self.paths):
+            if img_path not in records:
+                records[img_path] = self.get_record(row)
+
+        self.paths = list(records.keys())
+        self.mtimes = np.array([record[0] for record in records.values()], dtype=np.int64)
+        self.file_sizes = np.array([record[1] for record in records.values()], dtype=np.int64)
+        self.sizes = np.array([record[2:4] for record in records.values()], dtype=np.int32).reshape(-1, 2)
+        self.modes = [record[4] for record in records.values()]
+        self.errors = [record[5] for record in records.values()]
+        self.path2row = None
+        self.invalid_paths = {path: error for path, error in zip(self.paths, self.errors) if error}
+        self.save()
+
+        num_checked = sum(result is not None for result in results)
+        num_invalid = sum(img_path in self.invalid_paths for img_path in img_paths)
+        rank0_print(f"Image index {self.path}: {num_checked} images checked, {len(img_paths) - num_checked} unchanged, {num_invalid} invalid.")
+
+    def save(self):
+        columns = dict(mtimes=self.mtimes, file_sizes=self.file_sizes, sizes=self.sizes)
+        for key, strings in (("paths", self.paths), ("modes", self.modes), ("errors", self.errors)):
+            column = StringColumn.from_strings(strings)
+            columns[key], columns[f"{key}_offsets"] = column.buffer, column.offsets
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path[:-4]}.{uuid.uuid4().hex[:8]}.tmp.npz"
+        np.savez(tmp_path, **columns)
+        os.replace(tmp_path, self.path)
+
+
+def _check_image(task):
+    return ImageIndex.check_image(*task)
+
+
+if __name__ == "__main__":
+    from .dataset import EDGETensorDataset
+    from .item_store import ItemStore
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index-path", type=str, required=True, help="The .npz file of the image index.")
+    parser.add_argument("--config", type=str, default=None, help="The dataset config whose images are checked.")
+    parser.add_argument("--items-filepath", type=str, default=None, help="The jsonl file of dumped items.")
+    parser.add_argument("--anno-index-dir", type=str, default=None)
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    assert args.index_path.endswith(".npz"), "The index path must end with .npz!"
+
+    img_paths = set()
+    if args.config:
+        with open(args.config) as f:
+            dataset_meta = json.load(f)["train"]
+        # every task is materialized here, to enumerate its images
+        dataset_meta = copy.deepcopy(dataset_meta)
+        for task_meta in dataset_meta.values():
+            task_meta["lazy"] = False
+        task2vqas, _ = EDGETensorDataset.create_vqa_text_dataset(dataset_meta, args.num_workers, args.anno_index_dir)
+        for task_data in task2vqas.values():
+            for elem_task_data in task_data.values():
+                img_paths.update(item["images"][0] for item in elem_task_data)
+    if args.items_filepath:
+        img_paths.update(item["images"][0] for item in ItemStore(args.items_filepath))
+    ImageIndex(args.index_path).update(img_paths, args.num_workers)
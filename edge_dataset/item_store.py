@@ -0,0 +1,132 @@
+import os
+import json
+import uuid
+import numpy as np
+from tqdm import tqdm
+
+from utils.utils_ddp import rank0_print
+
+
+class ItemStore:
+    """
+    Read-only sequence of items stored as JSON lines and located through a byte-offset index, so that only the line of
+    a requested item is parsed. The file is memory-mapped, and the index is a few numpy arrays, so the memory of a
+    process does not grow with the number of items, nor is it copied into forked dataloader workers by refcount
+    updates. The index also maps every `task;elem_task` id to the positions of its items, for `get_task_item`.
+
+    The index is cached next to the file as `<path>.idx.npz`, and rebuilt when the size or mtime of the file changes.
+    Token lengths of the items can be stored along as `<path>.len.npy`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        index = self.load_index(path)
+        self.spans = index["spans"]
+        self.task_ids = index["task_ids"]
+        self.task_names = json.loads(index["task_names"].tobytes().decode("utf-8"))
+        self.num_qas = int(index["num_qas"])
+        lengths_path = path + ".len.npy"
+        self.lengths = np.load(lengths_path).tolist() if os.path.exists(lengths_path) else None
+        if self.lengths is not None and len(self.lengths) != len(self):
+            self.lengths = None
+        self.task_positions = {}
+        self.data = None
+        rank0_print(f"Item store {path}: {len(self)} items ({self.num_qas} QAs).")
+
+    def __getstate__(self):
+        # the memory map is reopened by every process instead of being pickled
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Item index {idx} out of range!")
+        if self.data is None:
+            self.data = np.memmap(self.path, dtype=np.uint8, mode="r")
+        start, end = self.spans[idx]
+        return json.loads(self.data[start:end].tobytes().decode("utf-8", errors="surrogatepass"))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def get_task_item(self, task_name, idx):
+        """The `idx`-th item with the id `task_name` (i.e. `task;elem_task`)."""
+        if task_name not in self.task_positions:
+            task_id = self.task_names.index(task_name) if task_name in self.task_names else -1
+            self.task_positions[task_name] = np.flatnonzero(self.task_ids == task_id)
+        return self[int(self.task_positions[task_name][idx])]
+
+    @staticmethod
+    def get_num_qas(item):
+        return len(item["messages" if "messages" in item else "conversations"]) // 2
+
+    @classmethod
+    def load_index(cls, path):
+        stat = os.stat(path)
+        index_path = path + ".idx.npz"
+        if os.path.exists(index_path):
+            with np.load(index_path) as index:
+                index = dict(index)
+            if int(index["size"]) == stat.st_size and int(index["mtime_ns"]) == stat.st_mtime_ns:
+                return index
+
+        spans, task_ids, task_names, num_qas = [], [], {}, 0
+        with open(path, "rb") as f:
+            offset = 0
+            for line in tqdm(f, desc=f"Indexing {path}"):
+                if line.strip():
+                    item = json.loads(line.decode("utf-8", errors="surrogatepass"))
+                    spans.append((offset, offset + len(line)))
+                    task_ids.append(task_names.setdefault(item.get("id", ""), len(task_names)))
+                    num_qas += cls.get_num_qas(item)
+                offset += len(line)
+        index = cls.create_index(spans, task_ids, list(task_names), num_qas, stat)
+        try:
+            cls.save_index(index_path, index)
+        except OSError as e:
+            rank0_print(f"Failed to cache the item index of {path}: {e}")
+        return index
+
+    @staticmethod
+    def create_index(spans, task_ids, task_names, num_qas, stat):
+        return dict(
+            spans=np.array(spans, dtype=np.int64).reshape(-1, 2),
+            task_ids=np.array(task_ids, dtype=np.int32),
+            task_names=np.frombuffer(json.dumps(task_names).encode("utf-8"), dtype=np.uint8),
+            num_qas=np.array(num_qas),
+            size=np.array(stat.st_size),
+            mtime_ns=np.array(stat.st_mtime_ns),
+        )
+
+    @staticmethod
+    def save_index(index_path, index):
+        # other ranks may be writing the same index, the last complete one wins
+        tmp_path = f"{index_path[:-4]}.{uuid.uuid4().hex[:8]}.tmp.npz"
+        np.savez(tmp_path, **index)
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def write(cls, path, items, lengths=None):
+        spans, task_ids, task_names, num_qas = [], [], {}, 0
+        with open(path + ".tmp", "wb") as f:
+            for item in tqdm(items, desc="Writing items"):
+                start = f.tell()
+                f.write((json.dumps(item, ensure_ascii=False) + "\n").encode("utf-8", errors="surrogatepass"))
+                spans.append((start, f.tell()))
+                task_ids.append(task_names.setdefault(item.get("id", ""), len(task_names)))
+                num_qas += cls.get_num_qas(item)
+        os.replace(path + ".tmp", path)
+        if lengths is not None:
+            np.save(path + ".len.tmp.npy", np.asarray(lengths, dtype=np.int32))
+            os.replace(path + ".len.tmp.npy", path + ".len.npy")
+        elif os.path.exists(path + ".len.npy"):
+            os.remove(path + ".len.npy")
+        cls.save_index(path + ".idx.npz", cls.create_index(spans, task_ids, list(task_names), num_qas, os.stat(path)))
+        rank0_print(f"Successfully write {len(spans)} items to {path}.")
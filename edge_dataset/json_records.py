@@ -0,0 +1,256 @@
+import os
+import re
+import json
+import mmap
+import uuid
+import random
+import argparse
+import numpy as np
+from tqdm import tqdm
+
+from utils.utils_ddp import rank0_print
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+    # only the C backend is faster than the stdlib decoder
+    ijson_backend = ijson.get_backend("yajl2_c")
+except ImportError:
+    ijson = ijson_backend = None
+
+
+def loads(data):
+    """Parse a JSON document from bytes, with orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # e.g. lone surrogates, which orjson rejects
+            pass
+    return json.loads(data.decode("utf-8", errors="surrogatepass"))
+
+
+def dumps(record):
+    """Serialize a record into one line of compact JSON bytes, with orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(record)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8", errors="surrogatepass")
+
+
+def has_surrogate_escapes(path):
+    """Whether a file may hold \\u escapes of UTF-16 surrogates, which yajl turns into "?" when they are lone."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return re.search(rb"\\u[dD][89a-fA-F]", data) is not None
+
+
+def iter_json_array(path, chunk_size=1 << 20):
+    """
+    Yield the elements of the top-level JSON array of a file one by one, reading it in chunks, so that the whole
+    file is never held in memory. The C backend of ijson parses it when it is installed, unless the file may hold
+    lone surrogates, which only the stdlib decoder keeps.
+    """
+    if ijson_backend is not None and not has_surrogate_escapes(path):
+        yield from iter_json_array_ijson(path)
+        return
+
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer, chunk = "", " "
+        # leading whitespace may fill whole chunks
+        while chunk and not buffer:
+            chunk = f.read(chunk_size)
+            buffer = chunk.lstrip()
+        assert buffer.startswith("["), f"{path} is not a JSON array!"
+        pos = 1
+        eof = False
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                # an element counts only once a delimiter follows it: one cut at the end of the buffer may still
+                # decode, e.g. a number cut right after its "." or "e" decodes as its shorter prefix
+                element, end = decoder.raw_decode(buffer, pos)
+                if end == len(buffer) and not eof or end < len(buffer) and buffer[end] not in " \t\r\n,]":
+                    raise ValueError
+            except ValueError:
+                if eof:
+                    raise ValueError(f"Invalid or truncated JSON array in {path}!")
+                chunk = f.read(max(chunk_size, len(buffer) - pos))
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield element
+            pos = end
+
+
+def iter_json_array_ijson(path):
+    with open(path, "rb") as f:
+        head = f.read(1 << 10).lstrip()
+        assert head.startswith(b"["), f"{path} is not a JSON array!"
+        f.seek(0)
+        try:
+            yield from ijson_backend.items(f, "item", use_float=True)
+        except ijson.JSONError as e:
+            raise ValueError(f"Invalid or truncated JSON array in {path}: {e}")
+
+
+class Reservoir:
+    """Uniform sample of at most `k` of the records added one by one, with memory bounded by `k`."""
+
+    def __init__(self, k, rng=random):
+        self.k = k
+        self.rng = rng
+        self.records = []
+        self.num_seen = 0
+
+    def add(self, record):
+        if len(self.records) < self.k:
+            self.records.append(record)
+        else:
+            idx = self.rng.randrange(self.num_seen + 1)
+            if idx < self.k:
+                self.records[idx] = record
+        self.num_seen += 1
+
+
+def reservoir_sample(records, k, rng=random):
+    """A uniform sample of at most `k` records in random order, drawn in one pass, and the number of records seen."""
+    reservoir = Reservoir(k, rng)
+    for record in records:
+        reservoir.add(record)
+    rng.shuffle(reservoir.records)
+    return reservoir.records, reservoir.num_seen
+
+
+class JsonlRecords:
+    """
+    Records of a JSONL file, read at random through the byte spans of its lines. The spans are kept next to the file
+    as `<path>.idx.npy`, and rebuilt by a vectorized scan for newlines when they do not match the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) > 0 else np.zeros(0, np.uint8)
+        self.spans = self.load_spans()
+
+    def load_spans(self):
+        index_path = self.path + ".idx.npy"
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(self.path):
+            spans = np.load(index_path)
+            if len(spans) == 0 or spans[-1, 1] <= len(self.data):
+                return spans
+        ends = np.flatnonzero(self.data == ord("\n")) + 1
+        if len(self.data) > 0 and self.data[-1] != ord("\n"):
+            ends = np.append(ends, len(self.data))
+        starts = np.concatenate([[0], ends[:-1]]).astype(np.int64)
+        spans = np.stack([starts, ends], axis=1).reshape(-1, 2)
+        # skip blank lines
+        spans = spans[spans[:, 1] - spans[:, 0] > 1]
+        try:
+            self.save_spans(index_path, spans)
+        except OSError as e:
+            rank0_print(f"Failed to cache the offset index of {self.path}: {e}")
+        return spans
+
+    @staticmethod
+    def save_spans(index_path, spans):
+        # other ranks may be writing the same index, the last complete one wins
+        tmp_path = f"{index_path[:-4]}.{uuid.uuid4().hex[:8]}.tmp.npy"
+        np.save(tmp_path, spans)
+        os.replace(tmp_path, index_path)
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __getitem__(self, idx):
+        start, end = self.spans[idx]
+        return loads(self.data[start:end].tobytes())
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield loads(line)
+
+
+def get_jsonl_path(path):
+    return os.path.splitext(path)[0] + ".jsonl"
+
+
+def convert_to_jsonl(path):
+    """Convert a file holding a JSON array into JSONL next to it, with the offset index of its lines."""
+    jsonl_path = get_jsonl_path(path)
+    spans = []
+    with open(jsonl_path + ".tmp", "wb") as f:
+        for record in tqdm(iter_json_array(path), desc=f"Converting {path}"):
+            start = f.tell()
+            f.write(dumps(record) + b"\n")
+            spans.append((start, f.tell()))
+    os.replace(jsonl_path + ".tmp", jsonl_path)
+    JsonlRecords.save_spans(jsonl_path + ".idx.npy", np.array(spans, dtype=np.int64).reshape(-1, 2))
+    return JsonlRecords(jsonl_path)
+
+
+def open_jsonl(path):
+    """JsonlRecords of the JSONL conversion of a JSON array file, or None if it is missing or not newer than the file."""
+    jsonl_path = get_jsonl_path(path)
+    if os.path.exists(jsonl_path) and os.path.getmtime(jsonl_path) > os.path.getmtime(path):
+        return JsonlRecords(jsonl_path)
+    return None
+
+
+def iter_json_records(path):
+    """Yield the records of a JSON array file in order, from its JSONL conversion if there is an up-to-date one."""
+    records = open_jsonl(path)
+    yield from records if records is not None else iter_json_array(path)
+
+
+def sample_json_records(path, k, rng=random):
+    """
+    A uniform sample of at most `k` records of a JSON array file in random order, and the number of its records.
+    With an up-to-date JSONL conversion, only the sampled lines are parsed, otherwise the file is streamed through a
+    reservoir.
+    """
+    records = open_jsonl(path)
+    if records is None:
+        return reservoir_sample(iter_json_array(path), k, rng)
+    ids = rng.sample(range(len(records)), min(k, len(records)))
+    return [records[idx] for idx in ids], len(records)
+
+
+def iter_shuffled_json_records(path, rng=random):
+    """
+    Yield all records of a JSON array file in random order. With an up-to-date JSONL conversion, records are parsed
+    only as they are consumed.
+    """
+    records = open_jsonl(path)
+    if records is None:
+        records = list(iter_json_array(path))
+        rng.shuffle(records)
+        yield from records
+        return
+    for idx in rng.sample(range(len(records)), len(records)):
+        yield records[idx]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="JSON array files to convert into JSONL with offset indexes.")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        records = convert_to_jsonl(path)
+        rank0_print(f"Converted {len(records)} records of {path} into {records.path}.")
@@ -0,0 +1,221 @@
+import math
+import random
+import numpy as np
+
+from torch.utils.data import Sampler
+
+from utils.utils_ddp import get_rank, get_world_size, rank0_print
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Group sample indices into batches whose padded size (batch size x longest length, rounded up to
+    `pad_to_multiple_of`) fits in `max_tokens`. Batches are formed once, so that the number of steps is fixed, and
+    their order is reshuffled every epoch. Every rank takes an equal share of the batches.
+    """
+
+    def __init__(self, lengths, max_tokens, pad_to_multiple_of=1, max_batch_size=None,
+                 num_replicas=None, rank=None, shuffle=True, seed=0):
+        self.num_replicas = num_replicas if num_replicas is not None else get_world_size()
+        self.rank = rank if rank is not None else get_rank()
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        self.batches = self.create_batches(lengths, max_tokens, pad_to_multiple_of, max_batch_size, seed)
+        num_batches = len(self.batches)
+        # repeat a few batches so that every rank runs the same number of steps
+        self.batches += self.batches[:(-num_batches) % self.num_replicas]
+
+        num_tokens = sum(lengths)
+        num_padded = sum(
+            len(batch) * math.ceil(max(lengths[idx] for idx in batch) / pad_to_multiple_of) * pad_to_multiple_of
+            for batch in self.batches[:num_batches]
+        )
+        rank0_print(
+            f"Token budget {max_tokens}: {len(lengths)} samples in {num_batches} batches "
+            f"(avg. {len(lengths) / num_batches:.2f} per batch), non-padding ratio {num_tokens / num_padded:.2%}."
+        )
+
+    @staticmethod
+    def create_batches(lengths, max_tokens, pad_to_multiple_of=1, max_batch_size=None, seed=0):
+        indices = list(range(len(lengths)))
+        random.Random(seed).shuffle(indices)
+
+        batches = []
+        batch, batch_len = [], 0
+        for idx in indices:
+            length = math.ceil(lengths[idx] / pad_to_multiple_of) * pad_to_multiple_of
+            new_batch_len = max(batch_len, length)
+            if batch and (new_batch_len * (len(batch) + 1) > max_tokens or len(batch) == max_batch_size):
+                batches.append(batch)
+                batch, new_batch_len = [], length
+            batch.append(idx)
+            batch_len = new_batch_len
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.batches) // self.num_replicas
+
+    def __iter__(self):
+        order = list(range(len(self.batches)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        for batch_idx in order[self.rank::self.num_replicas]:
+            yield self.batches[batch_idx]
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """
+    Batches of `batch_size` samples of similar lengths, so that dynamic padding actually saves compute. Every epoch,
+    the samples are shuffled and cut into megabatches of `megabatch_mult` steps, which are sorted by length and cut
+    into steps of one batch per rank; the steps are then shuffled, with the one holding the longest sample first so
+    that an OOM shows up at once. Every rank takes its own batch of each step, so ranks run similar lengths in sync.
+    """
+
+    def __init__(self, lengths, batch_size, megabatch_mult=50, pad_to_multiple_of=1,
+                 num_replicas=None, rank=None, seed=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas if num_replicas is not None else get_world_size()
+        self.rank = rank if rank is not None else get_rank()
+        self.step_size = batch_size * self.num_replicas
+        self.megabatch_size = self.step_size * megabatch_mult
+        # a few samples are repeated so that every rank runs the same number of full batches
+        self.num_steps = math.ceil(len(lengths) / self.step_size)
+        self.seed = seed
+        self.epoch = 0
+
+        indices = self.get_indices(random.Random(seed))
+        uniform_batches = [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+        grouped_batches = [step[i:i + batch_size] for step in self.create_steps(0) for i in range(0, len(step), batch_size)]
+        num_tokens = sum(lengths[idx] for idx in indices)
+        rank0_print(
+            f"Length grouping: {len(lengths)} samples in {self.num_steps} steps of {self.num_replicas}x{batch_size}, "
+            f"non-padding ratio {num_tokens / self.get_num_padded(uniform_batches, pad_to_multiple_of):.2%} shuffled -> "
+            f"{num_tokens / self.get_num_padded(grouped_batches, pad_to_multiple_of):.2%} grouped."
+        )
+
+    def get_num_padded(self, batches, pad_to_multiple_of=1):
+        return sum(
+            len(batch) * math.ceil(max(self.lengths[idx] for idx in batch) / pad_to_multiple_of) * pad_to_multiple_of
+            for batch in batches
+        )
+
+    def get_indices(self, rng):
+        indices = list(range(len(self.lengths)))
+        rng.shuffle(indices)
+        num_samples = self.num_steps * self.step_size
+        return (indices * math.ceil(num_samples / len(indices)))[:num_samples]
+
+    def create_steps(self, epoch):
+        rng = random.Random(self.seed + epoch)
+        indices = self.get_indices(rng)
+        steps = []
+        for start in range(0, len(indices), self.megabatch_size):
+            megabatch = sorted(indices[start:start + self.megabatch_size], key=lambda idx: self.lengths[idx], reverse=True)
+            steps += [megabatch[i:i + self.step_size] for i in range(0, len(megabatch), self.step_size)]
+        rng.shuffle(steps)
+        longest = max(range(len(steps)), key=lambda i: self.lengths[steps[i][0]])
+        steps[0], steps[longest] = steps[longest], steps[0]
+        return steps
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_steps
+
+    def __iter__(self):
+        steps = self.create_steps(self.epoch)
+        for step in steps:
+            yield step[self.rank * self.batch_size:(self.rank + 1) * self.batch_size]
+
+
+class TaskMixtureBatchSampler(Sampler):
+    """
+    Batches drawn from per-task pools of sample indices in the proportions of a mixture, instead of materializing
+    repeated items. Task `t` of `n_t` samples with weight `w_t` is drawn with a probability proportional to
+    `(w_t * n_t) ** (1 / temperature)`: temperature 1 keeps the weighted sizes, and higher temperatures flatten the
+    mixture towards uniform. Within a task, samples are drawn without replacement, cycling through a fresh permutation
+    of its pool whenever it is exhausted.
+
+    Every epoch of `num_samples` samples (by default the size of all pools) is drawn from an RNG seeded by
+    (seed, epoch), identically on every rank, which takes its own batch of each step. The realized number of samples
+    and tokens (with `lengths`) of every task are counted for all ranks, and taken by `pop_task_stats`.
+    """
+
+    def __init__(self, task_pools, batch_size, weights=None, temperature=1.0, num_samples=None, lengths=None,
+                 num_replicas=None, rank=None, seed=0):
+        weights = weights or {}
+        assert set(weights).issubset(task_pools), f"Mixture weights of unknown tasks: {set(weights) - set(task_pools)}!"
+        assert temperature > 0, "The mixture temperature must be positive!"
+        self.num_replicas = num_replicas if num_replicas is not None else get_world_size()
+        self.rank = rank if rank is not None else get_rank()
+        self.batch_size = batch_size
+        self.step_size = batch_size * self.num_replicas
+        self.lengths = lengths
+        self.seed = seed
+        self.epoch = 0
+
+        # tasks of zero weight or without samples are left out
+        sizes = {task: len(pool) * weights.get(task, 1.0) for task, pool in task_pools.items()}
+        self.tasks = [task for task, size in sizes.items() if size > 0]
+        assert self.tasks, "No task of the mixture has any sample!"
+        self.pools = [np.asarray(task_pools[task], dtype=np.int64) for task in self.tasks]
+        probs = np.array([sizes[task] for task in self.tasks], dtype=np.float64) ** (1 / temperature)
+        self.probs = probs / probs.sum()
+        num_samples = num_samples or sum(len(pool) for pool in task_pools.values())
+        self.num_steps = math.ceil(num_samples / self.step_size)
+        self.task_counts = np.zeros(len(self.tasks), dtype=np.int64)
+        self.task_tokens = np.zeros(len(self.tasks), dtype=np.int64)
+
+        num_samples = self.num_steps * self.step_size
+        message = f"Task mixture (temperature {temperature}): {num_samples} samples per epoch in {self.num_steps} steps."
+        for task, pool, prob in zip(self.tasks, self.pools, self.probs):
+            message += f"\n\t{task}: {len(pool)} samples, p={prob:.4f}, {prob * num_samples / len(pool):.2f} passes per epoch"
+        rank0_print(message)
+
+    def create_samples(self, epoch):
+        rng = np.random.default_rng([self.seed, epoch])
+        sample_tasks = rng.choice(len(self.tasks), size=self.num_steps * self.step_size, p=self.probs)
+        samples = np.zeros(len(sample_tasks), dtype=np.int64)
+        for task_idx, pool in enumerate(self.pools):
+            positions = np.flatnonzero(sample_tasks == task_idx)
+            num_passes = math.ceil(len(positions) / len(pool))
+            samples[positions] = np.concatenate([rng.permutation(pool) for _ in range(num_passes)] or [pool[:0]])[:len(positions)]
+        return sample_tasks, samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_steps
+
+    def __iter__(self):
+        sample_tasks, samples = self.create_samples(self.epoch)
+        for start in range(0, len(samples), self.step_size):
+            # counted when handed to the dataloader, i.e. a few prefetched batches ahead of training
+            step_tasks = sample_tasks[start:start + self.step_size]
+            self.task_counts += np.bincount(step_tasks, minlength=len(self.tasks))
+            if self.lengths is not None:
+                step_lengths = [self.lengths[idx] for idx in samples[start:start + self.step_size]]
+                self.task_tokens += np.bincount(step_tasks, weights=step_lengths, minlength=len(self.tasks)).astype(np.int64)
+            batch_start = start + self.rank * self.batch_size
+            yield samples[batch_start:batch_start + self.batch_size].tolist()
+
+    def pop_task_stats(self):
+        """Number of samples (and tokens) of every task drawn on all ranks since the last call."""
+        stats = {}
+        for task, count, tokens in zip(self.tasks, self.task_counts.tolist(), self.task_tokens.tolist()):
+            stats[f"mixture/{task}/samples"] = count
+            if self.lengths is not None:
+                stats[f"mixture/{task}/tokens"] = tokens
+        self.task_counts[:] = 0
+        self.task_tokens[:] = 0
+        return stats
@@ -0,0 +1,218 @@
+import io
+import os
+import json
+import random
+import tarfile
+import argparse
+import urllib.request
+from tqdm import tqdm
+from multiprocessing import Pool
+
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from utils.utils_ddp import get_rank, get_world_size, rank0_print
+from .dataset import EDGETensorDataset
+from .file_index import FileIndex
+
+
+def write_shard(shard_path, items, start_idx=0):
+    """Write items into a tar shard, each as a `{key}.json` record followed by the bytes of its image."""
+    with tarfile.open(shard_path + ".tmp", "w") as tar:
+        for i, item in enumerate(items):
+            key = f"{start_idx + i:09d}"
+            img_path = item["images"][0]
+            with open(img_path, "rb") as f:
+                img_bytes = f.read()
+            img_ext = os.path.splitext(img_path)[1].lower() or ".img"
+            for name, data in ((f"{key}.json", json.dumps(item, ensure_ascii=False).encode("utf-8", errors="surrogatepass")),
+                               (f"{key}{img_ext}", img_bytes)):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    os.replace(shard_path + ".tmp", shard_path)
+    return len(items)
+
+
+def _write_shard(args):
+    return write_shard(*args)
+
+
+def write_shards(items, out_dir, items_per_shard=2000, num_workers=1):
+    """Write items with their images into tar shards under `out_dir`, listed with their sizes in `index.json`."""
+    os.makedirs(out_dir, exist_ok=True)
+    items = [item for item in items if FileIndex.exists(item["images"][0])]
+    tasks = []
+    for shard_idx, start in enumerate(range(0, len(items), items_per_shard)):
+        shard_path = os.path.join(out_dir, f"shard_{shard_idx:06d}.tar")
+        tasks.append((shard_path, items[start:start + items_per_shard], start))
+    rank0_print(f"Writing {len(items)} items into {len(tasks)} shards ...")
+    if num_workers > 1:
+        with Pool(num_workers) as pool:
+            num_items = list(tqdm(pool.imap(_write_shard, tasks), total=len(tasks)))
+    else:
+        num_items = [write_shard(*task) for task in tqdm(tasks)]
+    shards = [dict(name=os.path.basename(task[0]), num_items=n) for task, n in zip(tasks, num_items)]
+    with open(os.path.join(out_dir, "index.json"), "w") as f:
+        json.dump(dict(num_items=sum(num_items), shards=shards), f, indent=2)
+
+
+def open_shard(shard_url):
+    if shard_url.startswith(("http://", "https://")):
+        return urllib.request.urlopen(shard_url)
+    return open(shard_url, "rb")
+
+
+def iter_shard(shard_url):
+    """Yield (item, image bytes) of the records of a shard, read sequentially."""
+    with open_shard(shard_url) as f, tarfile.open(fileobj=f, mode="r|*") as tar:
+        item = None
+        for member in tar:
+            if not member.isfile():
+                continue
+            data = tar.extractfile(member).read()
+            if member.name.endswith(".json"):
+                item = json.loads(data.decode("utf-8", errors="surrogatepass"))
+            elif item is not None:
+                yield item, data
+                item = None
+
+
+class EDGEStreamingDataset(IterableDataset):
+    """
+    Streaming counterpart of EDGETensorDataset, reading the tar shards written by `write_shards` from a local
+    directory or an http(s) mirror, with sequential reads only.
+
+    Every epoch, the shards are reshuffled and dealt out to the ranks, then to the dataloader workers of each rank, and
+    samples pass through a shuffle buffer. Everything is seeded by (seed, epoch, rank, worker), so the stream is
+    reproducible, and the Trainer's skipping of trained batches resumes exactly where a run stopped. Every dataloader
+    worker yields whole batches of `batch_size`, as many in total on every rank, so that no rank runs out of batches
+    before the others; `num_workers` must be the number of workers of the dataloader.
+    """
+
+    def __init__(self, tokenizer, shards_url, shuffle_buffer=1000, pad_to_max_len=True, image_transport="float32", seed=0,
+                 batch_size=1, num_workers=0, num_replicas=None, rank=None):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.max_len = tokenizer.model_max_length
+        self.pad_token_id = tokenizer.pad_token_id
+        self.pad_to_max_len = pad_to_max_len
+        self.image_transport = image_transport
+        self.shards_url = shards_url.rstrip("/")
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.num_replicas = num_replicas if num_replicas is not None else get_world_size()
+        self.rank = rank if rank is not None else get_rank()
+
+        with open_shard(f"{self.shards_url}/index.json") as f:
+            index = json.load(f)
+        self.shards = [(shard["name"], shard["num_items"]) for shard in index["shards"]]
+        assert len(self.shards) >= self.num_replicas, f"{len(self.shards)} shards can not be split across {self.num_replicas} ranks!"
+        rank0_print(f"Streaming {index['num_items']} items in {len(self.shards)} shards from {self.shards_url}.")
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_worker_totals(self, shards):
+        """Numbers of items in the shards of every dataloader worker of a rank."""
+        num_workers = max(self.num_workers, 1)
+        return [sum(num_items for _, num_items in shards[i::num_workers]) for i in range(num_workers)]
+
+    def get_rank_shards(self, epoch):
+        """
+        Shards of every rank in this epoch, and the number of batches every rank yields: the same on all ranks, and
+        made of whole batches of the workers of each rank.
+        """
+        shards = list(self.shards)
+        random.Random(self.seed + epoch).shuffle(shards)
+        rank_shards = [shards[rank::self.num_replicas] for rank in range(self.num_replicas)]
+        num_samples = min(sum(num_items for _, num_items in shards) for shards in rank_shards)
+        num_batches = min(
+            [num_samples // self.batch_size] +
+            [sum(total // self.batch_size for total in self.get_worker_totals(shards)) for shards in rank_shards]
+        )
+        return rank_shards[self.rank], num_batches
+
+    def get_worker_caps(self, shards, num_batches):
+        """Numbers of samples of the workers of a rank, in whole batches, split in proportion to their shards."""
+        worker_totals = self.get_worker_totals(shards)
+        total = sum(worker_totals)
+        worker_batches = [worker_total * num_batches // total if total else 0 for worker_total in worker_totals]
+        i = 0
+        while sum(worker_batches) < num_batches:
+            worker_idx = i % len(worker_totals)
+            if (worker_batches[worker_idx] + 1) * self.batch_size <= worker_totals[worker_idx]:
+                worker_batches[worker_idx] += 1
+            i += 1
+        return [n * self.batch_size for n in worker_batches]
+
+    def __len__(self):
+        return self.get_rank_shards(self.epoch)[1] * self.batch_size
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        assert num_workers == max(self.num_workers, 1), \
+            f"The dataset is set up for {self.num_workers} workers, but runs in {num_workers}!"
+        shards, num_batches = self.get_rank_shards(self.epoch)
+        worker_shards = [shards[i::num_workers] for i in range(num_workers)]
+        num_worker_samples = self.get_worker_caps(shards, num_batches)[worker_id]
+
+        rng = random.Random(f"{self.seed}-{self.epoch}-{self.rank}-{worker_id}")
+        buffer = []
+        num_yielded = 0
+        for item, img_bytes in self.iter_records(worker_shards[worker_id]):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append((item, img_bytes))
+                continue
+            idx = rng.randrange(len(buffer))
+            record, buffer[idx] = buffer[idx], (item, img_bytes)
+            if num_yielded == num_worker_samples:
+                return
+            yield self.get_sample(*record)
+            num_yielded += 1
+        rng.shuffle(buffer)
+        for record in buffer[:num_worker_samples - num_yielded]:
+            yield self.get_sample(*record)
+
+    def iter_records(self, shards):
+        for shard_name, _ in shards:
+            yield from iter_shard(f"{self.shards_url}/{shard_name}")
+
+    def get_sample(self, item, img_bytes):
+        input_id, target = EDGETensorDataset.tokenize_item(item, self.tokenizer)
+        input_id, target = input_id[:self.max_len], target[:self.max_len]
+        if self.pad_to_max_len:
+            input_id, target = EDGETensorDataset.pad_tokens(input_id, target, self.pad_token_id)
+        input_ids = torch.tensor(input_id, dtype=torch.int)
+        img = EDGETensorDataset.read_resized_img(io.BytesIO(img_bytes))
+        return dict(
+            input_ids=input_ids,
+            labels=torch.tensor(target, dtype=torch.int),
+            attention_mask=input_ids.ne(self.pad_token_id),
+            images=EDGETensorDataset.transport_resized_img(img, self.image_transport),
+        )
+
+
+if __name__ == "__main__":
+    from monkey_model.tokenization_qwen import QWenTokenizer
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out-dir", type=str, required=True, help="The directory to write the shards to.")
+    parser.add_argument("--config", type=str, default=None, help="The dataset config to create items from.")
+    parser.add_argument("--items-filepath", type=str, default=None, help="The jsonl file of dumped items.")
+    parser.add_argument("--tokenizer", type=str, default="monkey_model")
+    parser.add_argument("--items-per-shard", type=int, default=2000)
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    tokenizer = QWenTokenizer.from_pretrained(args.tokenizer)
+    dataset_meta = None
+    if args.config:
+        with open(args.config) as f:
+            dataset_meta = json.load(f)["train"]
+    dataset = EDGETensorDataset(tokenizer, dataset_meta=dataset_meta, items_filepath=args.items_filepath, num_workers=args.num_workers)
+    write_shards(list(dataset.items), args.out_dir, items_per_shard=args.items_per_shard, num_workers=args.num_workers)
@@ -0,0 +1,204 @@
+import os
+import json
+import glob
+import uuid
+import socket
+import time
+import hashlib
+import argparse
+import numpy as np
+from tqdm import tqdm
+from multiprocessing import Pool
+
+from utils.utils_ddp import rank0_print
+
+
+class TokenCache:
+    """
+    On-disk cache of tokenized items. The input ids and labels of each item are stored as variable-length int32 arrays
+    in memory-mapped shards, and located by an offset index keyed by the hash of the item content.
+
+    The cache lives in a sub-directory named by the fingerprint of the tokenizer vocabulary, `max_len` and the chat
+    template, so that a changed tokenizer or template never reads stale token ids. Every process appends what it
+    tokenizes to its own shard, which makes lazy filling from dataloader workers and parallel prefilling safe. On a
+    miss, the records that other processes appended to the indexes since they were read are loaded first (at most
+    every `reload_interval` seconds), so that workers forked again every epoch find what earlier ones tokenized.
+    """
+    reload_interval = 30
+    index_dtype = np.dtype([("key", "S32"), ("offset", "<i8"), ("length", "<i4")])
+    probe_item = {"messages": [
+        {"role": "user", "content": "Picture 1: <img>probe.png</img>\nWhere is the probe? (with point (x, y))"},
+        {"role": "assistant", "content": "(0.5, 0.5)"},
+    ]}
+
+    def __init__(self, cache_dir, tokenizer, max_len, tokenize_fn):
+        self.tokenizer = tokenizer
+        self.max_len = max_len
+        self.tokenize_fn = tokenize_fn
+        self.cache_dir = os.path.join(cache_dir, self.get_fingerprint(tokenizer, max_len, tokenize_fn))
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.shards = []
+        self.keys = np.empty(0, dtype="S32")
+        self.entries = np.empty(0, dtype=[("shard", "<i4"), ("offset", "<i8"), ("length", "<i4")])
+        self.new_entries = {}
+        # index path -> (shard, number of its records loaded)
+        self.index_shards = {}
+        self.writer = None
+        self.writer_pid = None
+        self.load_index()
+        rank0_print(f"Token cache {self.cache_dir}: {len(self.keys)} items in {len(self.shards)} shards.")
+
+    @classmethod
+    def get_fingerprint(cls, tokenizer, max_len, tokenize_fn):
+        sha = hashlib.sha1()
+        for token, rank in sorted(tokenizer.get_vocab().items(), key=lambda x: x[1]):
+            sha.update(token if isinstance(token, bytes) else token.encode("utf-8"))
+            sha.update(rank.to_bytes(4, "little"))
+        sha.update(json.dumps(getattr(tokenizer, "special_tokens", {}), sort_keys=True).encode("utf-8"))
+        sha.update(str(max_len).encode("utf-8"))
+        # any change of the chat template changes the tokens of the probe item
+        sha.update(json.dumps(tokenize_fn(cls.probe_item, tokenizer)).encode("utf-8"))
+        return sha.hexdigest()[:16]
+
+    @staticmethod
+    def get_item_key(item):
+        message_tag = "messages" if "messages" in item else "conversations"
+        content = json.dumps(item[message_tag], ensure_ascii=False, sort_keys=True)
+        return hashlib.md5(content.encode("utf-8")).hexdigest().encode("ascii")
+
+    def load_index(self):
+        """Load the records appended to the shard indexes since they were last read, including those of new shards."""
+        keys, entries = [self.keys], [self.entries]
+        for index_path in sorted(glob.glob(os.path.join(self.cache_dir, "*.idx"))):
+            if index_path in self.index_shards:
+                shard, num_loaded = self.index_shards[index_path]
+            else:
+                shard, num_loaded = len(self.shards), 0
+                self.shards.append([index_path[:-4] + ".bin", None])
+            with open(index_path, "rb") as f:
+                f.seek(num_loaded * self.index_dtype.itemsize)
+                buffer = f.read()
+            # drop a record that is possibly being written by another process, it is read with the next load
+            records = np.frombuffer(buffer[:len(buffer) - len(buffer) % self.index_dtype.itemsize], dtype=self.index_dtype)
+            self.index_shards[index_path] = (shard, num_loaded + len(records))
+            shard_entries = np.empty(len(records), dtype=self.entries.dtype)
+            shard_entries["shard"] = shard
+            shard_entries["offset"] = records["offset"]
+            shard_entries["length"] = records["length"]
+            keys.append(records["key"])
+            entries.append(shard_entries)
+
+        keys, entries = np.concatenate(keys), np.concatenate(entries)
+        if len(keys) > len(self.keys):
+            order = np.argsort(keys, kind="stable")
+            self.keys, self.entries = keys[order], entries[order]
+        self.load_time = time.monotonic()
+
+    def lookup(self, key):
+        if key in self.new_entries:
+            return self.new_entries[key]
+        pos = np.searchsorted(self.keys, key)
+        if pos < len(self.keys) and self.keys[pos] == key:
+            entry = self.entries[pos]
+            return int(entry["shard"]), int(entry["offset"]), int(entry["length"])
+        return None
+
+    def read(self, shard, offset, length):
+        shard_path, data = self.shards[shard]
+        # the shard may have grown since it was mapped, when this process is the one writing it
+        if data is None or len(data) < offset + 2 * length:
+            data = np.memmap(shard_path, dtype=np.int32, mode="r")
+            self.shards[shard][1] = data
+        input_id = data[offset:offset + length].tolist()
+        target = data[offset + length:offset + 2 * length].tolist()
+        return input_id, target
+
+    def write(self, key, input_id, target):
+        if self.writer_pid != os.getpid():
+            # never share a shard with the parent process after a fork
+            name = f"{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+            shard_path = os.path.join(self.cache_dir, name + ".bin")
+            index_path = os.path.join(self.cache_dir, name + ".idx")
+            self.writer = (open(shard_path, "ab"), open(index_path, "ab"), len(self.shards))
+            self.writer_pid = os.getpid()
+            self.shards.append([shard_path, None])
+            self.index_shards[index_path] = (self.writer[2], 0)
+
+        shard_file, index_file, shard = self.writer
+        offset = shard_file.tell() // 4
+        shard_file.write(np.asarray(input_id, dtype=np.int32).tobytes())
+        shard_file.write(np.asarray(target, dtype=np.int32).tobytes())
+        shard_file.flush()
+        # the record is written only after its data, so that readers never see a dangling offset
+        record = np.array([(key, offset, len(input_id))], dtype=self.index_dtype)
+        index_file.write(record.tobytes())
+        index_file.flush()
+        self.new_entries[key] = (shard, offset, len(input_id))
+        # own records are in new_entries already, and skipped by load_index
+        index_shard, num_loaded = self.index_shards[index_file.name]
+        self.index_shards[index_file.name] = (index_shard, num_loaded + 1)
+
+    def get(self, item):
+        """Truncated input ids and labels of an item, tokenized and added to the cache on a miss."""
+        key = self.get_item_key(item)
+        entry = self.lookup(key)
+        if entry is None and time.monotonic() - self.load_time > self.reload_interval:
+            self.load_index()
+            entry = self.lookup(key)
+        if entry is not None:
+            return self.read(*entry)
+        input_id, target = self.tokenize_fn(item, self.tokenizer)
+        input_id, target = input_id[:self.max_len], target[:self.max_len]
+        self.write(key, input_id, target)
+        return input_id, target
+
+    def get_length(self, item):
+        entry = self.lookup(self.get_item_key(item))
+        if entry is not None:
+            return entry[2]
+        return len(self.get(item)[0])
+
+    def build(self, items, num_workers=1):
+        missing = [item for item in items if self.lookup(self.get_item_key(item)) is None]
+        rank0_print(f"Tokenizing {len(missing)} of {len(items)} items into the token cache ...")
+        if num_workers <= 1:
+            for item in tqdm(missing):
+                self.get(item)
+            return
+        global _build_cache
+        _build_cache = self
+        chunks = [missing[i::num_workers] for i in range(num_workers)]
+        with Pool(num_workers) as pool:
+            pool.map(_build_chunk, chunks)
+        self.load_index()
+
+
+_build_cache = None
+
+def _build_chunk(items):
+    for item in items:
+        _build_cache.get(item)
+
+
+if __name__ == "__main__":
+    from monkey_model.tokenization_qwen import QWenTokenizer
+    from .dataset import EDGETensorDataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache-dir", type=str, required=True, help="The root directory of the token cache.")
+    parser.add_argument("--config", type=str, default=None, help="The dataset config to create items from.")
+    parser.add_argument("--items-filepath", type=str, default=None, help="The jsonl file of dumped items.")
+    parser.add_argument("--tokenizer", type=str, default="monkey_model")
+    parser.add_argument("--max-len", type=int, default=2048, help="The model_max_length used in training.")
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    tokenizer = QWenTokenizer.from_pretrained(args.tokenizer, model_max_length=args.max_len)
+    dataset_meta = None
+    if args.config:
+        with open(args.config) as f:
+            dataset_meta = json.load(f)["train"]
+    dataset = EDGETensorDataset(tokenizer, dataset_meta=dataset_meta, items_filepath=args.items_filepath, num_workers=args.num_workers)
+    token_cache = TokenCache(args.cache_dir, tokenizer, dataset.max_len, EDGETensorDataset.tokenize_item)
+    token_cache.build(dataset.items, num_workers=args.num_workers)
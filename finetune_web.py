@@ -6,20 +6,25 @@ from dataclasses import dataclass, field
 
 import torch
 import transformers
-from transformers import Trainer, deepspeed
+from transformers import deepspeed
 from accelerate.utils import DistributedType
 
 from monkey_model.modeling_monkey import MonkeyLMHeadModel
 from monkey_model.tokenization_qwen import QWenTokenizer
 from monkey_model.configuration_monkey import MonkeyConfig
 from edge_dataset.dataset import EDGETensorDataset
+from edge_dataset.collator import EDGEDataCollator
+from edge_dataset.streaming import EDGEStreamingDataset
 from utils.utils_ddp import rank0_print
-from utils.utils_training import fix_model_params, print_trainable_params, setup_seed
+from utils.utils_training import EDGETrainer, fix_model_params, print_trainable_params, setup_seed
 
 
 @dataclass
 class ModelArguments:
     model_name_or_path: Optional[str] = field(default="")
+    skip_blank_tiles: bool = field(
+        default=False, metadata={"help": "Skip the ViT for nearly uniform windows of screenshots, e.g. blank margins."}
+    )
 
 
 @dataclass
@@ -27,6 +32,35 @@ class DataArguments:
     data_path: str = field(
         default="", metadata={"help": "Path to the training data."}
     )
+    token_cache_dir: Optional[str] = field(
+        default=None, metadata={"help": "Directory of the pre-tokenized item cache, filled lazily if not prebuilt."}
+    )
+    image_cache_dir: Optional[str] = field(
+        default=None, metadata={"help": "Directory of the resized screenshot cache, filled lazily if not prebuilt."}
+    )
+    image_cache_size_gb: float = 200
+    image_transport: str = field(
+        default="float32", metadata={"help": "Dtype of the images shipped by dataloader workers: float32 or bf16 tiles, or uint8 images tiled on the device."}
+    )
+    vit_feature_dir: Optional[str] = field(
+        default=None, metadata={"help": "Directory of the offline ViT trunk features, used in place of images with fix_vit."}
+    )
+    dataset_num_workers: int = field(
+        default=1, metadata={"help": "Number of processes to read annotations and create QAs with."}
+    )
+    anno_index_dir: Optional[str] = field(
+        default=None, metadata={"help": "Directory of the persistent indexes of filtered page annotations."}
+    )
+    image_index_path: Optional[str] = field(
+        default=None, metadata={"help": "Image index built by edge_dataset.image_index, whose invalid images are skipped."}
+    )
+    stream_shards_url: Optional[str] = field(
+        default=None, metadata={"help": "Directory or http(s) url of the tar shards to stream training data from, in place of data_path."}
+    )
+    stream_shuffle_buffer: int = 1000
+    items_build_dir: Optional[str] = field(
+        default=None, metadata={"help": "Shared directory where rank 0 writes the built items for all ranks to memory-map."}
+    )
 
 
 @dataclass
@@ -44,6 +78,19 @@ class TrainingArguments(transformers.TrainingArguments):
     ddp_find_unused_parameters: bool = False
     dataloader_num_workers: int = 16
     max_grad_norm: float = 2.0
+    dynamic_padding: bool = field(
+        default=False,
+        metadata={"help": "Pad each batch to its longest sequence instead of padding every sample to the max length."}
+    )
+    pad_to_multiple_of: int = 64
+    max_tokens_per_batch: int = field(
+        default=0,
+        metadata={"help": "Per-device token budget of a batch, replacing per_device_train_batch_size when positive. Requires dynamic_padding."}
+    )
+    megabatch_mult: int = field(
+        default=50,
+        metadata={"help": "Number of steps whose samples are sorted by length together with group_by_length."}
+    )
 
 
 @dataclass
@@ -70,12 +117,54 @@ def safe_save_model_for_hf_trainer(trainer, output_dir: str):
         trainer._save(output_dir, state_dict=state_dict)
 
 
-def create_data_module(tokenizer, data_args) -> dict:
+def create_data_module(tokenizer, data_args, training_args) -> dict:
     """Make dataset and collator for supervised fine-tuning."""
     
+    assert training_args.dynamic_padding or not training_args.max_tokens_per_batch, "max_tokens_per_batch requires dynamic_padding!"
+    assert training_args.dynamic_padding or not training_args.group_by_length, "group_by_length requires dynamic_padding!"
+    assert not data_args.vit_feature_dir or (training_args.fix_vit and not training_args.use_lora), \
+        "Cached ViT features can only be used with a frozen ViT trunk!"
+    data_collator = EDGEDataCollator(tokenizer.pad_token_id, pad_to_multiple_of=training_args.pad_to_multiple_of)
+    if data_args.stream_shards_url:
+        assert not (training_args.max_tokens_per_batch or training_args.group_by_length or data_args.vit_feature_dir), \
+            "Streaming does not support max_tokens_per_batch, group_by_length or cached ViT features!"
+        dataset_train = EDGEStreamingDataset(
+            tokenizer,
+            data_args.stream_shards_url,
+            shuffle_buffer=data_args.stream_shuffle_buffer,
+            pad_to_max_len=not training_args.dynamic_padding,
+            image_transport=data_args.image_transport,
+            seed=training_args.seed,
+            batch_size=training_args.per_device_train_batch_size,
+            num_workers=training_args.dataloader_num_workers,
+        )
+        return dict(train_dataset=dataset_train, data_collator=data_collator)
+    
     with open(data_args.data_path) as f:
         dataset_meta = json.load(f)
-    dataset_train = EDGETensorDataset(tokenizer, dataset_meta=dataset_meta["train"])
+    assert not (dataset_meta.get("mixture") and (training_args.max_tokens_per_batch or training_args.group_by_length)), \
+        "A task mixture can not be combined with max_tokens_per_batch or group_by_length!"
+    dataset_train = EDGETensorDataset(
+        tokenizer, 
+        dataset_meta=dataset_meta["train"], 
+        packing=dataset_meta.get("packing"), 
+        grouping=dataset_meta.get("grouping"), 
+        splitting=dataset_meta.get("splitting"), 
+        mixture=dataset_meta.get("mixture"), 
+        tiling=dataset_meta.get("tiling"), 
+        pad_to_max_len=not training_args.dynamic_padding,
+        token_cache_dir=data_args.token_cache_dir,
+        image_cache_dir=data_args.image_cache_dir,
+        image_cache_size_gb=data_args.image_cache_size_gb,
+        image_transport=data_args.image_transport,
+        vit_feature_dir=data_args.vit_feature_dir,
+        num_workers=data_args.dataset_num_workers,
+        items_build_dir=data_args.items_build_dir,
+        anno_index_dir=data_args.anno_index_dir,
+        image_index_path=data_args.image_index_path,
+        measure_lengths=bool(training_args.max_tokens_per_batch or training_args.group_by_length or dataset_meta.get("mixture")),
+        seed=training_args.seed
+    )
     # dataset_train = EDGETensorDataset(tokenizer, items_filepath="edge_dataset/processed/test_data.jsonl")
 
     logging.debug("build dataset, done.")
@@ -85,6 +174,7 @@ def create_data_module(tokenizer, data_args) -> dict:
     return dict(
         train_dataset=dataset_train, 
         # eval_dataset=dataset_val
+        data_collator=data_collator,
     )
 
 
@@ -106,12 +196,13 @@ def train():
     rank0_print("Initializing config and model ...")
     config = MonkeyConfig.from_pretrained(model_args.model_name_or_path)
     config.use_cache = False
+    config.skip_blank_tiles = model_args.skip_blank_tiles
     model = MonkeyLMHeadModel.from_pretrained(model_args.model_name_or_path, config=config, torch_dtype=torch.bfloat16)
     model = fix_model_params(model, model_args, training_args, lora_args)
     print_trainable_params(model)
     
     ### Load data
-    data_module = create_data_module(tokenizer=tokenizer, data_args=data_args)
+    data_module = create_data_module(tokenizer=tokenizer, data_args=data_args, training_args=training_args)
 
     ### Start trainner
     trainer_args = dict(
@@ -120,7 +211,7 @@ def train():
         args=training_args, 
         **data_module
     )
-    trainer = Trainer(**trainer_args)
+    trainer = EDGETrainer(**trainer_args)
     
     trainer.train()
     trainer.save_state()
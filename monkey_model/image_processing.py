@@ -0,0 +1,120 @@
+import numpy as np
+from PIL import Image
+
+import torch
+import torch.nn.functional as F
+
+IMAGE_SIZE = 896
+WINDOW_SIZE = 448
+IMAGE_MEAN = (0.48145466, 0.4578275, 0.40821073)
+IMAGE_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def decode_resized(img_file, size=IMAGE_SIZE):
+    """
+    Decode an image and resize it to `size` x `size` with bicubic interpolation in uint8, as an array of (H, W, C).
+    JPEGs much larger than the target are decoded at a reduced scale by the codec itself, though never below twice the
+    target, so that the bicubic resize still does the actual downscaling.
+    """
+    with Image.open(img_file) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", (2 * size, 2 * size))
+        return np.array(img.convert("RGB").resize((size, size), Image.BICUBIC))
+
+
+def select_grid(width, height, max_windows=4, window_size=WINDOW_SIZE):
+    """
+    (rows, cols) of the grid of windows to tile an image of `width` x `height` into, with at most `max_windows`
+    windows: the grid keeping the most of the image's pixels when it is fit in without distortion, and among those,
+    the one wasting the least area, so that small images get a single window and elongated ones an elongated grid.
+    """
+    best_key, best_grid = None, None
+    for rows in range(1, max_windows + 1):
+        for cols in range(1, max_windows // rows + 1):
+            grid_w, grid_h = cols * window_size, rows * window_size
+            scale = min(grid_w / width, grid_h / height)
+            kept = min(width * height * scale * scale, width * height)
+            key = (kept, kept - grid_w * grid_h)
+            if best_key is None or key > best_key:
+                best_key, best_grid = key, (rows, cols)
+    return best_grid
+
+
+def count_tiles(width, height, max_windows=4):
+    """Number of tiles an image of `width` x `height` gets from `decode_tiled` and `split_resized`, without decoding it."""
+    rows, cols = select_grid(width, height, max_windows)
+    return rows * cols + 1 if rows * cols > 1 else 1
+
+
+def decode_tiled(img_file, max_windows=4):
+    """
+    Decode an image and fit it into the grid chosen by `select_grid` with bicubic interpolation, keeping its aspect
+    ratio: the image is placed at the top left, and the rest is filled with the mean color, which normalizes to 0.
+    Returns a uint8 array of (rows * 448, cols * 448, C).
+    """
+    with Image.open(img_file) as img:
+        rows, cols = select_grid(*img.size, max_windows)
+        grid_w, grid_h = cols * WINDOW_SIZE, rows * WINDOW_SIZE
+        scale = min(grid_w / img.width, grid_h / img.height)
+        size = (min(grid_w, max(1, round(img.width * scale))), min(grid_h, max(1, round(img.height * scale))))
+        if img.format == "JPEG":
+            img.draft("RGB", (2 * size[0], 2 * size[1]))
+        canvas = Image.new("RGB", (grid_w, grid_h), tuple(round(255 * mean) for mean in IMAGE_MEAN))
+        canvas.paste(img.convert("RGB").resize(size, Image.BICUBIC), (0, 0))
+        return np.array(canvas)
+
+
+def sliding_window(images, window_size, stride):
+    """Windows of images of (..., C, H, W) in row-major order, as a view of (..., rows, cols, C, h, w) without copies."""
+    windows = images.unfold(-2, window_size[0], stride).unfold(-2, window_size[1], stride)
+    # (..., C, rows, cols, h, w) -> (..., rows, cols, C, h, w)
+    return windows.movedim(-5, -3)
+
+
+def normalize(images):
+    """uint8 images of (..., C, H, W) scaled to [0, 1] and normalized, in float32, with in-place arithmetic on a new tensor."""
+    mean = torch.tensor(IMAGE_MEAN, device=images.device).view(3, 1, 1)
+    std = torch.tensor(IMAGE_STD, device=images.device).view(3, 1, 1)
+    # (x / 255 - mean) / std == x * scale - shift
+    return images.contiguous().float().mul_(1 / (255 * std)).sub_(mean / std)
+
+
+def split_resized(images):
+    """
+    Tiles of resized uint8 images, either one of (H, W, C) or a batch of (B, H, W, C) as arrays or tensors on any
+    device: the normalized windows of 448x448 in row-major order, followed by the global view downscaled from the
+    same normalized tensor, as (5, C, 448, 448) or (B, 5, C, 448, 448) for 896x896 images. Images of other multiples
+    of 448 (see `decode_tiled`) give rows * cols windows and the global view, or a single tile if they are 448x448.
+    """
+    images = torch.as_tensor(images)
+    batched = images.dim() == 4
+    images = normalize((images if batched else images.unsqueeze(0)).permute(0, 3, 1, 2))
+    windows = sliding_window(images, (WINDOW_SIZE, WINDOW_SIZE), WINDOW_SIZE).flatten(1, 2)
+    if windows.shape[1] == 1:
+        return windows if batched else windows.squeeze(0)
+    global_view = F.interpolate(images, size=(WINDOW_SIZE, WINDOW_SIZE), mode="bicubic")
+    tiles = torch.cat([windows, global_view.unsqueeze(1)], dim=1)
+    return tiles if batched else tiles.squeeze(0)
+
+
+def read_and_split(img_files):
+    """Tiles of (B, 5, C, 448, 448) of a batch of image files, through one batched normalization and interpolation."""
+    return split_resized(np.stack([decode_resized(img_file) for img_file in img_files]))
+
+
+def get_blank_tiles(tiles, max_std=0.02, max_edge_density=0.002, edge_threshold=0.1):
+    """
+    Mask of the nearly uniform tiles among normalized tiles of (..., C, H, W): the pixel std of every channel is below
+    `max_std`, and at most `max_edge_density` of the pixels differ from a neighbour by more than `edge_threshold`, all
+    on the [0, 1] scale. Also returns the mean color of every tile, of (..., C).
+    """
+    mean = torch.tensor(IMAGE_MEAN, device=tiles.device).view(3, 1, 1)
+    std = torch.tensor(IMAGE_STD, device=tiles.device).view(3, 1, 1)
+    pixels = tiles.float() * std + mean
+    colors = pixels.mean(dim=(-2, -1))
+    stds = pixels.std(dim=(-2, -1)).amax(dim=-1)
+    gray = pixels.mean(dim=-3)
+    edges_y = (gray[..., 1:, :] - gray[..., :-1, :]).abs() > edge_threshold
+    edges_x = (gray[..., :, 1:] - gray[..., :, :-1]).abs() > edge_threshold
+    edge_density = edges_y.float().mean(dim=(-2, -1)) + edges_x.float().mean(dim=(-2, -1))
+    return (stds < max_std) & (edge_density < max_edge_density), colors
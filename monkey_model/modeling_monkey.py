@@ -6,6 +6,7 @@ import torch.nn.functional as F
 from transformers.modeling_outputs import CausalLMOutputWithPast
 from transformers.utils import logging
 from .modeling_qwen import QWenModel, QWenLMHeadModel
+from .image_processing import get_blank_tiles, normalize, split_resized
 
 
 SUPPORT_CUDA = torch.cuda.is_available()
@@ -15,7 +16,59 @@ logger = logging.get_logger(__name__)
 class MonkeyModel(QWenModel):
     def __init__(self, config):
         super().__init__(config)
+        # nearly uniform windows (e.g. page margins) skip the ViT, see encode_images
+        self.skip_blank_tiles = getattr(config, "skip_blank_tiles", False)
+        self.blank_tile_max_std = getattr(config, "blank_tile_max_std", 0.02)
+        self.blank_tile_max_edge_density = getattr(config, "blank_tile_max_edge_density", 0.002)
+        # (blank windows, all windows) on the device, so that counting never waits for the GPU
+        self.blank_tile_counts = None
     
+    def encode_images(self, images, num_tiles=None):
+        """
+        ViT features of image tiles of (bs, 5, C, H, W), or of the (n_tiles, C, H, W) tiles of images of `num_tiles`
+        tiles each under adaptive tiling, where the last tile of an image is its global view, or the image itself if it
+        is the only one. With `skip_blank_tiles`, the nearly uniform windows (never the global view) skip the ViT, and
+        take the features of a uniform tile of their mean color instead, computed once per color. The image token spans
+        are unchanged, so positions need no bookkeeping.
+        """
+        if num_tiles is None:
+            bs, n_patchs = images.shape[:2]
+            tiles = images.flatten(0, 1)
+            is_window = torch.arange(n_patchs, device=tiles.device).lt(n_patchs - 1).repeat(bs)
+        else:
+            tiles = images
+            is_window = torch.ones(len(tiles), dtype=torch.bool, device=tiles.device)
+            is_window[num_tiles.cumsum(0) - 1] = False
+        feats = self.encode_tiles(tiles, is_window)
+        return feats.unflatten(0, sizes=(bs, n_patchs)) if num_tiles is None else feats
+    
+    def encode_tiles(self, tiles, is_window):
+        if not self.skip_blank_tiles:
+            return self.visual(tiles)
+        
+        blank, colors = get_blank_tiles(tiles, self.blank_tile_max_std, self.blank_tile_max_edge_density)
+        blank &= is_window
+        counts = torch.stack([blank.sum(), is_window.sum()])
+        self.blank_tile_counts = counts if self.blank_tile_counts is None else self.blank_tile_counts + counts
+        if not blank.any():
+            return self.visual(tiles)
+        
+        # uniform tiles of the same 8-bit color have the same features
+        colors, color_ids = torch.unique(colors[blank].mul(255).round().to(torch.uint8), dim=0, return_inverse=True)
+        uniform_tiles = normalize(colors[:, :, None, None].expand(-1, -1, *tiles.shape[-2:]))
+        num_kept = len(tiles) - len(color_ids)
+        outputs = self.visual(torch.cat([tiles[~blank], uniform_tiles.to(tiles.dtype)]))
+        feats = outputs.new_empty((len(tiles), *outputs.shape[1:]))
+        feats[~blank] = outputs[:num_kept]
+        feats[blank] = outputs[num_kept:][color_ids]
+        return feats
+    
+    def pop_blank_tile_stats(self):
+        """Numbers of blank windows skipped, and of all windows seen, since the last call, as a tensor of (2,)."""
+        counts = self.blank_tile_counts if self.blank_tile_counts is not None else torch.zeros(2, dtype=torch.long)
+        self.blank_tile_counts = None
+        return counts
+        
     
     def forward(
         self,
@@ -33,11 +86,30 @@ class MonkeyModel(QWenModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         images: Optional[torch.FloatTensor] = None,
+        image_features: Optional[torch.FloatTensor] = None,
+        num_tiles: Optional[torch.LongTensor] = None,
+        cu_seqlens: Optional[torch.IntTensor] = None,
+        max_seqlen: Optional[int] = None,
     ):
         if past_key_values is None:
-            bs, n_patchs, _, _, _ = images.shape  # (bs, 5, C, H, W)
-            feats = self.visual(images.flatten(0, 1)).unflatten(0, sizes=(bs, n_patchs))  # (bs, 5, seq_len, d_hidden)
-            images = feats.flatten(1, 2) # (bs, 5*seq_len, d_hidden)
+            if image_features is not None:
+                # cached outputs of the frozen ViT trunk, skipping it entirely
+                image_features = image_features.flatten(0, -4)
+                bs, n_patchs, _, _ = image_features.shape  # (bs, 5, vit_seq_len, width)
+                feats = self.visual.forward_head(image_features.flatten(0, 1)).unflatten(0, sizes=(bs, n_patchs))
+                images = feats.flatten(1, 2)
+            elif num_tiles is not None:
+                # adaptive tiling: (n_tiles, C, H, W) tiles of images with different grids, whose image-pad spans
+                # hold seq_len tokens per tile, so features go to the spans as a list
+                feats = self.encode_images(images, num_tiles)  # (n_tiles, seq_len, d_hidden)
+                images = [image_feats.flatten(0, 1) for image_feats in feats.split(num_tiles.tolist())]
+            else:
+                if images.dtype == torch.uint8:
+                    # resized images of (n_imgs, H, W, C) shipped compactly by the dataloader, tiled on the device
+                    images = split_resized(images.flatten(0, -4))
+                images = images.flatten(0, -5)  # packed samples carry several images: (bs, n_imgs, 5, C, H, W)
+                feats = self.encode_images(images)  # (bs, 5, seq_len, d_hidden)
+                images = feats.flatten(1, 2) # (bs, 5*seq_len, d_hidden)
         else:
             images = None
         return super().forward(input_ids,
@@ -52,7 +124,9 @@ class MonkeyModel(QWenModel):
             output_attentions,
             output_hidden_states,
             return_dict,
-            images)
+            images,
+            cu_seqlens,
+            max_seqlen)
     
 
 
@@ -127,6 +201,10 @@ class MonkeyLMHeadModel(QWenLMHeadModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         images: Optional[torch.FloatTensor] = None,
+        image_features: Optional[torch.FloatTensor] = None,
+        num_tiles: Optional[torch.LongTensor] = None,
+        cu_seqlens: Optional[torch.IntTensor] = None,
+        max_seqlen: Optional[int] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
             
         return_dict = (
@@ -147,6 +225,10 @@ class MonkeyLMHeadModel(QWenLMHeadModel):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
             images=images,
+            image_features=image_features,
+            num_tiles=num_tiles,
+            cu_seqlens=cu_seqlens,
+            max_seqlen=max_seqlen,
         )
         hidden_states = transformer_outputs[0]
         lm_logits = self.lm_head(hidden_states)
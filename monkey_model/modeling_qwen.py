@@ -145,7 +145,7 @@ class FlashSelfAttention(torch.nn.Module):
         output[indices] = hidden_states
         return rearrange(output, '(b s) ... -> b s ...', b=batch)
 
-    def forward(self, q, k, v, attention_mask=None):
+    def forward(self, q, k, v, attention_mask=None, cu_seqlens=None, max_seqlen=None):
         assert all((i.dtype in [torch.float16, torch.bfloat16] for i in (q, k, v)))
         assert all((i.is_cuda for i in (q, k, v)))
         batch_size, seqlen_q = q.shape[0], q.shape[1]
@@ -162,7 +162,11 @@ class FlashSelfAttention(torch.nn.Module):
         )
         
 
-        if batch_size > 1 and attention_mask is not None:
+        if cu_seqlens is not None:
+            # packed sequences: every segment attends only to itself
+            cu_seqlens_q = cu_seqlens_k = cu_seqlens
+            seqlen_q = seqlen_k = max_seqlen
+        elif batch_size > 1 and attention_mask is not None:
             k, indices_k, cu_seqlens_k, seqlen_k = self.unpad_input(k, attention_mask)
             if q.size(0) == v.size(0):
                 q = q[indices_k]
@@ -198,7 +202,7 @@ class FlashSelfAttention(torch.nn.Module):
             softmax_scale=self.softmax_scale,
             causal=is_causal,
         )
-        if batch_size > 1 and attention_mask is not None and seqlen_q == seqlen_k:
+        if cu_seqlens is None and batch_size > 1 and attention_mask is not None and seqlen_q == seqlen_k:
             output = self.pad_input(output, indices_k, batch_size, seqlen_out)
         else:
             new_shape = (batch_size, output.shape[0] // batch_size) + output.shape[1:]
@@ -240,6 +244,28 @@ def _expand_mask(mask: torch.Tensor, dtype: torch.dtype, tgt_len: Optional[int]
     return inverted_mask.masked_fill(inverted_mask.to(torch.bool), torch.finfo(dtype).min)
 
 
+def _make_segment_mask(position_ids: torch.Tensor, dtype: torch.dtype):
+    """
+    Make block-diagonal mask `[bsz, 1, seq_len, seq_len]` for packed sequences, whose segments restart at position 0.
+    """
+    segment_ids = position_ids.eq(0).cumsum(dim=-1)
+    cross_segment = segment_ids[:, :, None] != segment_ids[:, None, :]
+    mask = torch.zeros(cross_segment.shape, dtype=dtype, device=position_ids.device)
+    return mask.masked_fill(cross_segment, torch.finfo(dtype).min)[:, None, :, :]
+
+
+def _get_cu_seqlens(position_ids: torch.Tensor):
+    """
+    Get the cumulative segment lengths of packed sequences (flattened over the batch) for varlen flash attention.
+    """
+    position_ids = position_ids.flatten()
+    starts = torch.nonzero(position_ids.eq(0), as_tuple=False).flatten()
+    total = torch.tensor([position_ids.numel()], device=position_ids.device)
+    cu_seqlens = torch.cat((starts, total)).to(torch.int32)
+    max_seqlen = (cu_seqlens[1:] - cu_seqlens[:-1]).max().item()
+    return cu_seqlens, max_seqlen
+
+
 class QWenAttention(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -399,6 +425,8 @@ class QWenAttention(nn.Module):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
         output_attentions: Optional[bool] = False,
         use_cache: Optional[bool] = False,
+        cu_seqlens: Optional[torch.Tensor] = None,
+        max_seqlen: Optional[int] = None,
     ):
 
         mixed_x_layer = self.c_attn(hidden_states)
@@ -437,7 +465,7 @@ class QWenAttention(nn.Module):
             query = query * logn_tensor.expand_as(query)
 
         if self.training and SUPPORT_TORCH2 and use_flash_attention:
-            attn_output = self.core_attention_flash(query,key,value)
+            attn_output = self.core_attention_flash(query, key, value, cu_seqlens=cu_seqlens, max_seqlen=max_seqlen)
             attn_weight = None
         else:
 
@@ -510,6 +538,8 @@ class QWenBlock(nn.Module):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
         use_cache: Optional[bool] = False,
         output_attentions: Optional[bool] = False,
+        cu_seqlens: Optional[torch.Tensor] = None,
+        max_seqlen: Optional[int] = None,
     ):
         layernorm_output = self.ln_1(hidden_states)
 
@@ -522,6 +552,8 @@ class QWenBlock(nn.Module):
             head_mask=head_mask,
             use_cache=use_cache,
             output_attentions=output_attentions,
+            cu_seqlens=cu_seqlens,
+            max_seqlen=max_seqlen,
         )
         attn_output = attn_outputs[0]
 
@@ -699,7 +731,9 @@ class QWenModel(QWenPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
-        images=None
+        images=None,
+        cu_seqlens: Optional[torch.Tensor] = None,
+        max_seqlen: Optional[int] = None,
     ):
         if images is None:
             if past_key_values is None and torch.any(input_ids == self.config.visual['image_start_id']):
@@ -757,6 +791,8 @@ class QWenModel(QWenPreTrainedModel):
             token_type_ids = token_type_ids.view(-1, input_shape[-1])
         if position_ids is not None:
             position_ids = position_ids.view(-1, input_shape[-1])
+        # position ids given during training come from packed sequences, where they restart for every segment
+        packed = self.training and position_ids is not None
 
         if past_key_values is None:
             past_length = 0
@@ -784,6 +820,16 @@ class QWenModel(QWenPreTrainedModel):
         attention_mask = self._prepare_decoder_attention_mask(
             attention_mask, input_shape, inputs_embeds, past_length
         )
+        if not packed:
+            cu_seqlens, max_seqlen = None, None
+        elif not (SUPPORT_TORCH2 and use_flash_attention):
+            # eager attention keeps the segments apart with a dense block-diagonal mask
+            attention_mask = attention_mask + _make_segment_mask(position_ids, inputs_embeds.dtype)
+            cu_seqlens, max_seqlen = None, None
+        elif cu_seqlens is None:
+            # varlen flash attention needs no mask, only the segment boundaries, which EDGEDataCollator
+            # computes on the CPU; otherwise they are found here once for all layers, at the cost of a host sync
+            cu_seqlens, max_seqlen = _get_cu_seqlens(position_ids)
 
         hidden_states = inputs_embeds
 
@@ -805,6 +851,9 @@ class QWenModel(QWenPreTrainedModel):
         rotary_pos_emb = self.rotary_emb(kv_seq_len, ntk_alpha=ntk_alpha)
         for idx in range(len(rotary_pos_emb)):
             rotary_pos_emb[idx] = rotary_pos_emb[idx].to(hidden_states.device)
+            if packed:
+                # (1, seq_len, 1, dim) -> (bsz, seq_len, 1, dim)
+                rotary_pos_emb[idx] = rotary_pos_emb[idx][0][position_ids]
 
         hidden_states = self.drop(hidden_states)
         if images is not None:
@@ -832,7 +881,7 @@ class QWenModel(QWenPreTrainedModel):
                 def create_custom_forward(module):
                     def custom_forward(*inputs):
                         # None for past_key_value
-                        return module(*inputs, use_cache, output_attentions)
+                        return module(*inputs, use_cache, output_attentions, cu_seqlens, max_seqlen)
 
                     return custom_forward
 
@@ -859,6 +908,8 @@ class QWenModel(QWenPreTrainedModel):
                     encoder_attention_mask=encoder_attention_mask,
                     use_cache=use_cache,
                     output_attentions=output_attentions,
+                    cu_seqlens=cu_seqlens,
+                    max_seqlen=max_seqlen,
                 )
 
             hidden_states = outputs[0]
@@ -1334,7 +1385,7 @@ def _rotate_half(x):
 
 def apply_rotary_pos_emb(t, freqs):
     cos, sin = freqs
-    if apply_rotary_emb_func is not None and t.is_cuda:
+    if apply_rotary_emb_func is not None and t.is_cuda and cos.size(0) == 1:
         t_ = t.float()
         cos = cos.squeeze(0).squeeze(1)[:, : cos.shape[-1] // 2]
         sin = sin.squeeze(0).squeeze(1)[:, : sin.shape[-1] // 2]
@@ -20,6 +20,8 @@ from torchvision import transforms
 from torchvision.transforms import InterpolationMode
 from flash_attn import flash_attn_func
 
+from .image_processing import IMAGE_MEAN, IMAGE_STD, sliding_window as sliding_window_view
+
 def reconstruct_matrix(windows):
     temp =[]
     for col in windows:
@@ -29,17 +31,9 @@ def reconstruct_matrix(windows):
 
 
 def sliding_window(matrix, window_size, stride):
-    b,c,height, width = matrix.shape
-    window_rows = (height - window_size[0]) // stride + 1
-    window_cols = (width - window_size[1]) // stride + 1
-    windows = []
-    for i in range(window_rows):
-        windows_col = []
-        for j in range(window_cols):
-            window = matrix[:,:, i*stride:i*stride+window_size[0],  j*stride:j*stride+window_size[1]]
-            windows_col.append(window)
-        windows.append(windows_col)
-    return windows
+    # rows of the (b, c, h, w) windows, as views into the matrix
+    windows = sliding_window_view(matrix, window_size, stride)
+    return [[windows[:, i, j] for j in range(windows.shape[2])] for i in range(windows.shape[1])]
 
 def get_resized_pos_vit(abs_pos):
     if not hasattr(get_resized_pos_vit, "resized_pos"):
@@ -400,8 +394,8 @@ class VisionTransformer(nn.Module):
         self.grid_size = (image_height // patch_height, image_width // patch_width)
         self.output_dim = output_dim
 
-        mean = (0.48145466, 0.4578275, 0.40821073)
-        std = (0.26862954, 0.26130258, 0.27577711)
+        mean = IMAGE_MEAN
+        std = IMAGE_STD
         self.image_transform = transforms.Compose([
             transforms.Resize(
                 (image_size, image_size),
@@ -441,7 +435,7 @@ class VisionTransformer(nn.Module):
         self.ln_post = norm_layer(output_dim)
         self.proj = nn.Parameter((output_dim** -0.5) * torch.randn(output_dim, output_dim))
 
-    def forward(self, x: torch.Tensor,idx=None):
+    def forward_trunk(self, x: torch.Tensor,idx=None):
         x = x.to(
             dtype=self.transformer.get_cast_dtype(),
             device=self.transformer.get_cast_device(),
@@ -459,12 +453,23 @@ class VisionTransformer(nn.Module):
             # x = x.permute(1, 0, 2)  # NLD -> LND
             x = self.transformer(x,idx=idx)
             # x = x.permute(1, 0, 2)  # LND -> NLD
+        return x
 
+    def forward_head(self, x: torch.Tensor):
+        # x: outputs of the (frozen) trunk, possibly read from an offline feature cache
+        x = x.to(
+            dtype=self.transformer.get_cast_dtype(),
+            device=self.transformer.get_cast_device(),
+        )
         x = self.attn_pool(x)
         x = self.ln_post(x)
         x = x @ self.proj
         return x
 
+    def forward(self, x: torch.Tensor,idx=None):
+        x = self.forward_trunk(x, idx=idx)
+        return self.forward_head(x)
+
 
 if __name__ == "__main__":
     pass
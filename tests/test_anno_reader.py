@@ -0,0 +1,104 @@
+import random
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from edge_dataset.anno_reader import EDGEAnnotationReader
+from utils.utils_data import BoxUtils
+
+
+def reference_filter_elements(elements, viewport):
+    """The per-page rules `filter_pages` replaced, kept verbatim as the reference."""
+    valid_elements = []
+    if len(elements) < 5 or len(elements) > 60:
+        return valid_elements
+
+    bboxes = np.array([element["bbox"] for element in elements])
+    width, height = BoxUtils.get_wh_array(bboxes)
+    if (width == 0).any() or (height == 0).any():
+        return valid_elements
+    vw, vh = viewport
+    if len(elements) > 5 and (width / height > 20).mean() > 0.5:
+        return valid_elements
+
+    if (width * height < vw * vh / 50**2).mean() > 0.4:
+        return valid_elements
+
+    text_elements = [element for element in elements if element["types"] == {"Text"}]
+    word_count = sum(len(element["text"].split()) for element in text_elements)
+    if len(elements) > 5 and len(text_elements) / len(elements) > 0.8 or (word_count > 300 and word_count / len(text_elements) > 30):
+        return valid_elements
+
+    text2cnt = Counter([element["text"] for element in elements])
+    for element in elements:
+        text, bbox, types = element["text"], element["bbox"], element["types"]
+        width, height = BoxUtils.get_wh(bbox)
+        if len(text) > 300 or len(text.split()) > 60:
+            continue
+        if height == 0 or width / height > 30 or width / height < 1/30:
+            continue
+        if width < 20 or height < 20 or width * height < 500:
+            continue
+        if len(types) == 0:
+            continue
+        if len(text) > 0 and text2cnt[text] > 1:
+            continue
+        valid_elements.append(element)
+
+    return valid_elements
+
+
+WORDS = ["a", "bb", "hello world", "", "x " * 40, "w " * 58, "y " * 70, "z" * 295, "z" * 310, "Text"]
+TYPES = [{"Text"}, {"Image"}, {"Text", "Icon"}, {"Button"}, {"Button"}, {"Button"}]
+
+
+def random_page(rng):
+    num_elements = rng.choice([0, 3, 5, 6, 6, 10, 10, 30, 61])
+    W, H = rng.choice([(1280, 720), (100, 100), (1920, 5000)])
+    # half of the pages are plausible ones, so most of them reach the element rules
+    plausible = rng.random() < 0.5
+    sizes = [0, 5, 25, 40, 100, 300, 300, 2000]
+    text_share = rng.choice([0.2, 0.5, 0.8, 0.9])
+    max_h = rng.choice([25, 120])
+    elements = []
+    for i in range(num_elements):
+        if plausible:
+            w, h = min(W, rng.randint(10, 600)), min(H, rng.randint(10, max_h))
+            x1, y1 = rng.randint(0, W - w), rng.randint(0, H - h)
+            x2, y2 = x1 + w, y1 + h
+            types = {"Text"} if rng.random() < text_share else set(rng.choice(TYPES[1:]))
+        else:
+            x1 = rng.randint(0, W)
+            x2 = rng.randint(x1, min(W, x1 + rng.choice(sizes)))
+            y1 = rng.randint(0, H)
+            y2 = rng.randint(y1, min(H, y1 + rng.choice(sizes)))
+            types = set() if rng.random() < 0.01 else set(rng.choice(TYPES))
+        text = rng.choice(WORDS) * rng.choice([1, 1, 2])
+        if plausible and rng.random() < 0.7:
+            text = f"{text[:rng.choice([20, 300])]} {i}"
+        elements.append(dict(bbox=[x1, y1, x2, y2], text=text, types=types))
+    return elements, [W, H]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_filter_pages_matches_reference(seed):
+    rng = random.Random(seed)
+    pages = [random_page(rng) for _ in range(5000)]
+    keeps = EDGEAnnotationReader.filter_pages(pages)
+    assert len(keeps) == len(pages)
+    num_kept = 0
+    for (elements, viewport), keep in zip(pages, keeps):
+        expected = reference_filter_elements(elements, viewport)
+        assert [id(element) for element, k in zip(elements, keep) if k] == [id(element) for element in expected]
+        num_kept += len(expected)
+    # the pages must exercise the element rules, not only the page rejections
+    assert num_kept > 0
+
+
+def test_filter_elements_single_page():
+    elements = [dict(bbox=[0, 0, 100 + i, 50], text=f"button {i}", types={"Button"}) for i in range(6)]
+    elements.append(dict(bbox=[0, 0, 100, 50], text="button 0", types={"Button"}))
+    kept = EDGEAnnotationReader.filter_elements(elements, [1280, 720])
+    assert kept == elements[1:6]
+    assert EDGEAnnotationReader.filter_elements([], [1280, 720]) == []
@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from edge_dataset.dataset import EDGETensorDataset
+
+
+IMG = "raw/0000000_top.png"
+PREFIX = f"Picture 1: <img>{IMG}</img>\n"
+
+
+def conversations_item(task, question, answer):
+    return {
+        "id": task,
+        "conversations": [{"from": "user", "value": PREFIX + question}, {"from": "assistant", "value": answer}],
+        "images": [IMG],
+    }
+
+
+def messages_item(task, question, answer):
+    return {
+        "id": task,
+        "messages": [{"role": "user", "content": PREFIX + question}, {"role": "assistant", "content": answer}],
+        "images": [IMG],
+    }
+
+
+def test_merge_conversations_items():
+    items = [conversations_item("basic;ocr", "q1", "a1"), conversations_item("captioning;caption", "q2", "a2")]
+    merged = EDGETensorDataset.merge_items(items)
+    assert "messages" not in merged
+    assert [message["value"] for message in merged["conversations"]] == [PREFIX + "q1", "a1", "q2", "a2"]
+    assert [message["from"] for message in merged["conversations"]] == ["user", "assistant"] * 2
+    assert merged["turn_ids"] == ["basic;ocr", "captioning;caption"]
+    assert merged["images"] == [IMG]
+
+
+def test_merge_mixed_styles_follows_first_item():
+    items = [messages_item("basic;ocr", "q1", "a1"), conversations_item("captioning;caption", "q2", "a2")]
+    merged = EDGETensorDataset.merge_items(items)
+    assert [message["content"] for message in merged["messages"]] == [PREFIX + "q1", "a1", "q2", "a2"]
+    assert [message["role"] for message in merged["messages"]] == ["user", "assistant"] * 2
+    # the inputs are left untouched
+    assert items[1]["conversations"][0]["value"] == PREFIX + "q2"
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+from edge_dataset import json_records
+from edge_dataset.json_records import iter_json_array
+
+
+ARRAYS = [
+    [1.5],
+    [1.5, -2.25e-3, 10, 0, 3e10, -0.0],
+    [12345, 6.02E+23, {"a": 1.5e2, "b": [1, 2.5]}, "1.5e3", True, None, False],
+    [{"id": "basic;ocr", "messages": [{"role": "user", "content": "x, y] {z}"}]}, [], {}, ""],
+]
+
+
+@pytest.fixture(params=["stdlib", "ijson"])
+def parser(request, monkeypatch):
+    if request.param == "stdlib":
+        monkeypatch.setattr(json_records, "ijson_backend", None)
+    elif json_records.ijson_backend is None:
+        pytest.skip("ijson is not installed")
+    return request.param
+
+
+@pytest.mark.parametrize("array", ARRAYS)
+@pytest.mark.parametrize("separators", [(",", ":"), (", ", ": "), (" ,\n", " : ")])
+def test_elements_split_at_chunk_boundaries(tmp_path, parser, array, separators):
+    path = tmp_path / "records.json"
+    text = " " + json.dumps(array, separators=separators) + "\n"
+    path.write_text(text, encoding="utf-8")
+    # every position of the text is a chunk boundary for some chunk size
+    for chunk_size in range(1, len(text) + 1):
+        assert list(iter_json_array(str(path), chunk_size=chunk_size)) == array
+
+
+def test_lone_surrogates_are_kept(tmp_path, parser):
+    path = tmp_path / "records.json"
+    path.write_text('[{"text": "\\ud800"}, "ok"]', encoding="utf-8")
+    assert list(iter_json_array(str(path), chunk_size=3)) == [{"text": "\ud800"}, "ok"]
+
+
+@pytest.mark.parametrize("text", ["[1.5", "[1.5, 2", "[1.5.2]", '[{"a": 1}'])
+def test_invalid_arrays_raise(tmp_path, parser, text):
+    path = tmp_path / "records.json"
+    path.write_text(text, encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(iter_json_array(str(path), chunk_size=2))
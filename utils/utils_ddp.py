@@ -1,7 +1,10 @@
-import torch.distributed as dist
+try:
+    import torch.distributed as dist
+except ImportError:
+    dist = None
 
 def is_dist_avail_and_initialized():
-    return dist.is_available() and dist.is_initialized()
+    return dist is not None and dist.is_available() and dist.is_initialized()
 
 
 def get_world_size():
@@ -15,6 +18,18 @@ def get_rank():
     return dist.get_rank()
 
 
+def barrier():
+    if is_dist_avail_and_initialized():
+        dist.barrier()
+
+
+def all_reduce_sum(tensor):
+    """Sum of a tensor over all ranks, in place."""
+    if is_dist_avail_and_initialized():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
 def is_main_process():
     return get_rank() == 0
 
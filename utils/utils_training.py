@@ -4,9 +4,12 @@ import numpy as np
 from time import time
 
 import torch
+from torch.utils.data import DataLoader, IterableDataset
+from transformers import Trainer, TrainerCallback
 from peft import LoraConfig, get_peft_model
 
-from .utils_ddp import is_main_process, rank0_print
+from edge_dataset.sampler import LengthGroupedBatchSampler, TaskMixtureBatchSampler, TokenBudgetBatchSampler
+from .utils_ddp import all_reduce_sum, is_main_process, rank0_print
 
 
 def print_trainable_params(model):
@@ -94,3 +97,121 @@ class Timer:
             curr_time = time()
             total_time = curr_time - cls.init_time
             print(f"{name} TIME (SO FAR): {total_time:.4f}")
+
+
+class SetEpochCallback(TrainerCallback):
+    """
+    Pass the epoch to a training dataset or batch sampler that reshuffles itself every epoch, before its workers are
+    started. The epoch comes from the trainer state, so that a resumed run draws the batches of the epoch it resumes,
+    which the Trainer's skipping of trained batches relies on.
+    """
+
+    def on_epoch_begin(self, args, state, control, train_dataloader=None, **kwargs):
+        for reshuffled in (getattr(train_dataloader, "dataset", None), getattr(train_dataloader, "batch_sampler", None)):
+            if hasattr(reshuffled, "set_epoch"):
+                reshuffled.set_epoch(int(state.epoch))
+
+
+class EDGETrainer(Trainer):
+    """
+    Trainer that additionally logs the token throughput and padding ratio between two logging steps, and batches
+    samples by a per-device token budget when `max_tokens_per_batch` is set, by similar lengths with
+    `group_by_length`, or from per-task pools when the dataset config has a `mixture`, whose realized per-task samples
+    and tokens are logged too, as is the ratio of blank windows skipped with `skip_blank_tiles`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.num_tokens = 0
+        self.num_positions = 0
+        self.throughput_start = None
+        self.mixture_sampler = None
+        # the MonkeyModel inside any wrappers, which counts the blank windows it skips
+        self.blank_tile_model = next((module for module in self.model.modules() if hasattr(module, "pop_blank_tile_stats")), None)
+        self.add_callback(SetEpochCallback)
+
+    def get_train_dataloader(self):
+        if isinstance(self.train_dataset, IterableDataset):
+            # a streaming dataset shards itself across ranks, so the dataloader is not prepared by accelerate;
+            # its workers yield whole batches, as many on every rank
+            assert (self.train_dataset.batch_size, self.train_dataset.num_workers) == \
+                (self.args.per_device_train_batch_size, self.args.dataloader_num_workers), \
+                "The streaming dataset must be set up with the batch size and workers of the dataloader!"
+            return DataLoader(
+                self.train_dataset,
+                batch_size=self.args.per_device_train_batch_size,
+                collate_fn=self.data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+            )
+        if self.args.max_tokens_per_batch:
+            batch_sampler = TokenBudgetBatchSampler(
+                self.train_dataset.get_lengths(),
+                max_tokens=self.args.max_tokens_per_batch,
+                pad_to_multiple_of=self.args.pad_to_multiple_of,
+                seed=self.args.seed,
+            )
+        elif getattr(self.train_dataset, "mixture", None):
+            mixture = self.train_dataset.mixture
+            # lengths of items created on the fly are unknown, so their tokens are not counted
+            lengths = self.train_dataset.get_lengths() if not self.train_dataset.lazy_readers else None
+            batch_sampler = self.mixture_sampler = TaskMixtureBatchSampler(
+                self.train_dataset.get_task_pools(),
+                batch_size=self.args.per_device_train_batch_size,
+                weights=mixture.get("weights"),
+                temperature=mixture.get("temperature", 1.0),
+                num_samples=mixture.get("num_samples"),
+                lengths=lengths,
+                seed=self.args.seed,
+            )
+        elif self.args.group_by_length:
+            batch_sampler = LengthGroupedBatchSampler(
+                self.train_dataset.get_lengths(),
+                batch_size=self.args.per_device_train_batch_size,
+                megabatch_mult=self.args.megabatch_mult,
+                pad_to_multiple_of=self.args.pad_to_multiple_of,
+                seed=self.args.seed,
+            )
+        else:
+            return super().get_train_dataloader()
+        # the batches are already split across ranks, so the dataloader is not prepared by accelerate
+        return DataLoader(
+            self.train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+    def _prepare_input(self, data):
+        # pinned batches are copied asynchronously; floating tensors are left to Trainer, which may cast them
+        if isinstance(data, torch.Tensor) and data.is_pinned() and not data.is_floating_point():
+            return data.to(self.args.device, non_blocking=True)
+        return super()._prepare_input(data)
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        if self.throughput_start is None:
+            self.throughput_start = time()
+        # summed on the device, read only when logging, so that no micro-step waits for the GPU
+        self.num_tokens = self.num_tokens + inputs["attention_mask"].sum()
+        self.num_positions += inputs["input_ids"].numel()
+        return super().training_step(model, inputs, *args, **kwargs)
+
+    def log(self, logs, *args, **kwargs):
+        if "loss" in logs and self.throughput_start is not None and self.num_positions > 0:
+            elapsed = time() - self.throughput_start
+            world_size = self.args.world_size
+            num_tokens = int(self.num_tokens)
+            logs["tokens_per_second"] = round(num_tokens * world_size / elapsed, 2)
+            logs["positions_per_second"] = round(self.num_positions * world_size / elapsed, 2)
+            logs["padding_ratio"] = round(1 - num_tokens / self.num_positions, 4)
+            self.num_tokens = self.num_positions = 0
+            self.throughput_start = time()
+        if "loss" in logs and self.mixture_sampler is not None:
+            logs.update(self.mixture_sampler.pop_task_stats())
+        if "loss" in logs and self.blank_tile_model is not None and self.blank_tile_model.skip_blank_tiles:
+            counts = self.blank_tile_model.pop_blank_tile_stats().to(self.args.device)
+            # summed over ranks only here, as every rank skips the windows of its own batches
+            num_blank, num_windows = all_reduce_sum(counts).tolist()
+            logs["blank_tile_ratio"] = round(num_blank / max(num_windows, 1), 4)
+        super().log(logs, *args, **kwargs)